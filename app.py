@@ -1,9 +1,67 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from controller.maps_controller import maps_controller  # Make sure this import is compatible with FastAPI
 from controller.user_controller import user_controller
+from controller.health_controller import health_controller
+import server_properties
+from helper import http_client, es_repository, background, metrics, cache
+from helper.mail_queue import mail_queue
+from helper.passwords import password_hasher
+from helper.write_buffer import write_buffer
+import logger
 
-app = FastAPI()
+log = logger.get_logger(__name__)
+
+
+async def run_step(name, step):
+    # Fail soft: a dependency that is down or unconfigured is logged and reported by /health/ready,
+    # and the remaining startup or shutdown steps still run
+    try:
+        result = step()
+        if hasattr(result, '__await__'):
+            await result
+    except Exception as e:
+        log.warning(f"{name} failed: {e!r}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm the connection pools and worker processes before the first request
+    if server_properties.missing_settings('elasticsearch'):
+        log.warning("Elasticsearch is not configured; skipping index setup")
+    else:
+        await run_step("Elasticsearch index setup", es_repository.ensure_indices)
+    await run_step("HTTP client warm-up", http_client.get_client)
+    await run_step("Shared cache warm-up", cache.ping)
+    await run_step("Password pool warm-up", password_hasher.warm_up)
+    missing_mail = server_properties.missing_settings('mail')
+    if missing_mail:
+        log.warning(f"Mail is not configured ({', '.join(missing_mail)} not set); notifications are disabled")
+    else:
+        await run_step("Mail queue start", mail_queue.start)
+    await run_step("Write-behind buffer start", write_buffer.start)
+    await run_step("Metrics publishing start", metrics.start_publishing)
+    yield
+    # Flush queued mail, let background refreshes finish and drain buffered writes,
+    # then release pooled upstream and Elasticsearch connections
+    await run_step("Metrics publishing stop", metrics.stop_publishing)
+    await run_step("Mail queue stop", mail_queue.stop)
+    await run_step("Background task drain", background.drain)
+    await run_step("Write-behind buffer stop", write_buffer.stop)
+    await run_step("HTTP client close", http_client.close)
+    await run_step("Elasticsearch client close", es_repository.close)
+    await run_step("Shared cache close", cache.close)
+    await run_step("Password pool shutdown", password_hasher.shutdown)
+
+app = FastAPI(lifespan=lifespan)
+
+@app.exception_handler(server_properties.MissingSettingError)
+async def missing_setting(request, exc):
+    # A subsystem without its settings is unavailable, the rest of the API keeps working
+    log.error(f"{request.url.path}: {exc}")
+    return JSONResponse(status_code=503, content={"detail": "Service is not configured."})
 
 # Enable CORS
 app.add_middleware(
@@ -13,10 +71,20 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Request latency histograms and the Server-Timing breakdown header
+app.add_middleware(metrics.MetricsMiddleware)
+# Request ids for the log records, added last so it wraps everything else
+app.add_middleware(logger.RequestIdMiddleware)
 
 # Register the maps controller router
 app.include_router(maps_controller)
 app.include_router(user_controller)
+app.include_router(health_controller)
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(body, media_type=content_type)
 
 if __name__ == '__main__':
     import uvicorn
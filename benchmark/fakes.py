@@ -0,0 +1,410 @@
+import asyncio
+import datetime
+import hashlib
+import json
+import operator
+import re
+from collections import Counter
+
+from fastapi import APIRouter, FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+from helper.geo import haversine_m
+
+# Stand-in places sit on a fixed grid, so overlapping searches find the same place ids
+PLACE_GRID_DEG = 0.002
+PLACES_PER_PAGE = 20
+
+
+def _unit(text):
+    # Deterministic pseudo-random number in [0, 1) derived from text
+    return int(hashlib.sha1(text.encode('utf-8')).hexdigest()[:8], 16) / 0x100000000
+
+
+class FakeGoogle:
+    """
+    Local stand-in for the Geocode, Places Nearby Search and Place Details APIs.
+    Answers are deterministic; every call sleeps for latency seconds and is counted.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.app = FastAPI()
+        router = APIRouter()
+        router.add_api_route("/geocode/json", self.geocode)
+        router.add_api_route("/place/nearbysearch/json", self.nearby_search)
+        router.add_api_route("/place/details/json", self.details)
+        self.app.include_router(router)
+
+    async def _respond(self, api):
+        self.calls[api] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def geocode(self, address: str, key: str = ''):
+        await self._respond('geocode')
+        # Every address lands somewhere in a 40 x 40 km box
+        latitude = 40.6 + 0.36 * _unit('lat' + address)
+        longitude = -74.2 + 0.47 * _unit('lng' + address)
+        return {"status": "OK", "results": [{"geometry": {"location": {"lat": latitude, "lng": longitude}}}]}
+
+    async def nearby_search(self, location: str, radius: int = 5000, keyword: str = '', key: str = ''):
+        await self._respond('nearby')
+        latitude, longitude = (float(value) for value in location.split(','))
+        row, col = round(latitude / PLACE_GRID_DEG), round(longitude / PLACE_GRID_DEG)
+        places = []
+        for i in range(row - 3, row + 4):
+            for j in range(col - 3, col + 4):
+                place_lat, place_lng = i * PLACE_GRID_DEG, j * PLACE_GRID_DEG
+                distance = haversine_m(latitude, longitude, place_lat, place_lng)
+                if distance <= radius:
+                    places.append((distance, self._place(f"fake_{i}_{j}", place_lat, place_lng)))
+        places.sort(key=lambda item: item[0])
+        results = [place for _, place in places[:PLACES_PER_PAGE]]
+        return {"status": "OK" if results else "ZERO_RESULTS", "results": results}
+
+    async def details(self, place_id: str, key: str = ''):
+        await self._respond('details')
+        place = self._place(place_id, 0.0, 0.0)
+        reviews = [
+            {"author_name": f"Reviewer {n}", "rating": 1 + int(5 * _unit(f"{place_id}{n}")), "text": "Benchmark review."}
+            for n in range(3)
+        ]
+        result = {**place, "formatted_address": place['vicinity'], "reviews": reviews}
+        return {"status": "OK", "result": result}
+
+    @staticmethod
+    def _place(place_id, latitude, longitude):
+        return {
+            "place_id": place_id,
+            "name": f"Restaurant {place_id}",
+            "vicinity": f"{place_id} Benchmark Street",
+            "rating": round(1 + 4 * _unit('rating' + place_id), 1),
+            "user_ratings_total": int(2000 * _unit('total' + place_id)),
+            "geometry": {"location": {"lat": latitude, "lng": longitude}},
+        }
+
+
+class SearchError(Exception):
+    pass
+
+
+def _field(document, path):
+    for part in path.split('.'):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(part)
+    return document
+
+
+def _date_math(value):
+    # Only the "now-<n><unit>" form the services use
+    match = re.fullmatch(r'now(?:-(\d+)([smhd]))?', value) if isinstance(value, str) else None
+    if match is None:
+        return value
+    seconds = int(match.group(1) or 0) * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[match.group(2) or 's']
+    return (datetime.datetime.utcnow() - datetime.timedelta(seconds=seconds)).isoformat()
+
+
+def _distance_m(text):
+    match = re.fullmatch(r'([\d.]+)\s*(m|km)?', str(text))
+    return float(match.group(1)) * (1000 if match.group(2) == 'km' else 1)
+
+
+def _geo_field(clause):
+    return next((field, point) for field, point in clause.items()
+                if field not in ('distance', 'order', 'unit', 'distance_type'))
+
+
+def _compile(query):
+    """
+    Turn a query into a predicate over documents, resolving date math and distances once.
+    """
+    if not query or 'match_all' in query:
+        return lambda document: True
+    if 'bool' in query:
+        clauses = query['bool']
+        required = [_compile(clause) for clause in clauses.get('filter', []) + clauses.get('must', [])]
+        excluded = [_compile(clause) for clause in clauses.get('must_not', [])]
+        return lambda document: (all(check(document) for check in required)
+                                 and not any(check(document) for check in excluded))
+    if 'term' in query:
+        field, value = next(iter(query['term'].items()))
+        value = value.get('value') if isinstance(value, dict) else value
+        return lambda document: _field(document, field) == value
+    if 'terms' in query:
+        field, values = next(iter(query['terms'].items()))
+        return lambda document: _field(document, field) in values
+    if 'range' in query:
+        field, bounds = next(iter(query['range'].items()))
+        operators = {'gte': operator.ge, 'gt': operator.gt, 'lte': operator.le, 'lt': operator.lt}
+        checks = [(operators[op], _date_math(bound)) for op, bound in bounds.items() if op in operators]
+
+        def in_range(document):
+            value = _field(document, field)
+            return value is not None and all(compare(value, bound) for compare, bound in checks)
+        return in_range
+    if 'geo_distance' in query:
+        field, point = _geo_field(query['geo_distance'])
+        distance = _distance_m(query['geo_distance']['distance'])
+        # Cheap latitude band check before the great-circle distance
+        band = distance / 111000 + 0.01
+
+        def within(document):
+            value = _field(document, field)
+            return (bool(value) and abs(value['lat'] - point['lat']) <= band
+                    and haversine_m(point['lat'], point['lon'], value['lat'], value['lon']) <= distance)
+        return within
+    raise SearchError(f"Unsupported query clause: {list(query)}")
+
+
+def _sort_key(document, sort):
+    """
+    Sort values of a document plus a key that orders them as the sort spec asks.
+    """
+    values, keys = [], []
+    for spec in sort:
+        field, options = next(iter(spec.items())) if isinstance(spec, dict) else (spec, {})
+        if isinstance(options, str):
+            options = {"order": options}
+        descending = options.get('order', 'asc') == 'desc'
+        if field == '_geo_distance':
+            field, point = _geo_field(options)
+            value = _field(document, field)
+            value = haversine_m(point['lat'], point['lon'], value['lat'], value['lon']) if value else None
+        else:
+            value = _field(document, field)
+        values.append(value)
+        # Missing values go last in either direction
+        if value is None:
+            keys.append((1, 0))
+        elif isinstance(value, (int, float)):
+            keys.append((0, -value if descending else value))
+        else:
+            keys.append((0, _Reversed(value) if descending else value))
+    return values, tuple(keys)
+
+
+class _Reversed:
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+class FakeElasticsearch:
+    """
+    In-memory stand-in for the parts of the Elasticsearch REST API the services use:
+    index management, document get/index/create/update, mget, bulk and filtered search
+    (term, terms, range with now-<n> date math, geo_distance; field and _geo_distance sort;
+    search_after). Scripted updates are not emulated. Every request sleeps for latency seconds.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.indices = {}
+        self.app = FastAPI()
+        router = APIRouter()
+        router.add_api_route("/", self.info, methods=["GET", "HEAD"])
+        router.add_api_route("/_bulk", self.bulk, methods=["POST", "PUT"])
+        router.add_api_route("/{index}", self.index_exists, methods=["HEAD"])
+        router.add_api_route("/{index}", self.create_index, methods=["PUT"])
+        router.add_api_route("/{index}/_mapping", self.put_mapping, methods=["PUT"])
+        router.add_api_route("/{index}/_search", self.search, methods=["GET", "POST"])
+        router.add_api_route("/{index}/_mget", self.mget, methods=["GET", "POST"])
+        router.add_api_route("/{index}/_doc", self.index_document, methods=["POST"])
+        router.add_api_route("/{index}/_doc/{id}", self.index_document, methods=["PUT", "POST"])
+        router.add_api_route("/{index}/_doc/{id}", self.get_document, methods=["GET"])
+        router.add_api_route("/{index}/_create/{id}", self.create_document, methods=["PUT", "POST"])
+        router.add_api_route("/{index}/_update/{id}", self.update_document, methods=["POST"])
+        self.app.include_router(router)
+
+    async def _begin(self, operation):
+        self.calls[operation] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    @staticmethod
+    def _json(body, status_code=200):
+        # The client refuses responses that don't identify as Elasticsearch
+        return JSONResponse(body, status_code=status_code, headers={"X-Elastic-Product": "Elasticsearch"})
+
+    @staticmethod
+    async def _body(request):
+        raw = await request.body()
+        return json.loads(raw) if raw else {}
+
+    def _error(self, status_code, error_type, reason):
+        return self._json({"error": {"type": error_type, "reason": reason}, "status": status_code}, status_code)
+
+    async def info(self):
+        return self._json({"name": "benchmark", "version": {"number": "9.0.0"}, "tagline": "You Know, for Search"})
+
+    async def index_exists(self, index: str):
+        await self._begin('indices')
+        return Response(status_code=200 if index in self.indices else 404,
+                        headers={"X-Elastic-Product": "Elasticsearch"})
+
+    async def create_index(self, index: str):
+        await self._begin('indices')
+        self.indices.setdefault(index, {})
+        return self._json({"acknowledged": True, "index": index})
+
+    async def put_mapping(self, index: str):
+        await self._begin('indices')
+        return self._json({"acknowledged": True})
+
+    def _store(self, index):
+        # Like Elasticsearch, writing to a missing index creates it
+        return self.indices.setdefault(index, {})
+
+    def _write(self, index, id, source, create=False):
+        store = self._store(index)
+        if create and id in store:
+            return 409, {"_index": index, "_id": id, "status": 409,
+                         "error": {"type": "version_conflict_engine_exception", "reason": "document already exists"}}
+        result = "updated" if id in store else "created"
+        store[id] = source
+        return 201 if result == "created" else 200, {"_index": index, "_id": id, "result": result}
+
+    def _update(self, index, id, body):
+        store = self._store(index)
+        if 'script' in body:
+            return 400, {"_index": index, "_id": id, "status": 400,
+                         "error": {"type": "illegal_argument_exception", "reason": "scripts are not emulated"}}
+        if id in store:
+            store[id] = {**store[id], **body.get('doc', {})}
+            return 200, {"_index": index, "_id": id, "result": "updated"}
+        if body.get('doc_as_upsert') or 'upsert' in body:
+            store[id] = body['doc'] if body.get('doc_as_upsert') else body['upsert']
+            return 201, {"_index": index, "_id": id, "result": "created"}
+        return 404, {"_index": index, "_id": id, "status": 404,
+                     "error": {"type": "document_missing_exception", "reason": "document missing"}}
+
+    async def index_document(self, index: str, request: Request, id: str = None):
+        await self._begin('index')
+        id = id or hashlib.sha1(f"{index}{len(self._store(index))}{datetime.datetime.utcnow()}".encode()).hexdigest()
+        status_code, result = self._write(index, id, await self._body(request))
+        return self._json(result, status_code)
+
+    async def create_document(self, index: str, id: str, request: Request):
+        await self._begin('create')
+        status_code, result = self._write(index, id, await self._body(request), create=True)
+        return self._json(result, status_code)
+
+    async def update_document(self, index: str, id: str, request: Request):
+        await self._begin('update')
+        status_code, result = self._update(index, id, await self._body(request))
+        return self._json(result, status_code)
+
+    async def get_document(self, index: str, id: str):
+        await self._begin('get')
+        document = self.indices.get(index, {}).get(id)
+        if document is None:
+            return self._json({"_index": index, "_id": id, "found": False}, 404)
+        return self._json({"_index": index, "_id": id, "found": True, "_source": document})
+
+    async def mget(self, index: str, request: Request):
+        await self._begin('mget')
+        store = self.indices.get(index, {})
+        docs = []
+        for id in (await self._body(request)).get('ids', []):
+            document = store.get(id)
+            docs.append({"_index": index, "_id": id, "found": document is not None,
+                         **({"_source": document} if document is not None else {})})
+        return self._json({"docs": docs})
+
+    async def search(self, index: str, request: Request):
+        await self._begin('search')
+        body = await self._body(request)
+        try:
+            matches = _compile(body.get('query'))
+        except SearchError as e:
+            return self._error(400, "parsing_exception", str(e))
+        hits = [(id, document) for id, document in self.indices.get(index, {}).items() if matches(document)]
+
+        sort = body.get('sort', [])
+        ranked = []
+        for id, document in hits:
+            values, key = _sort_key(document, sort)
+            ranked.append((key, values, id, document))
+        if sort:
+            ranked.sort(key=lambda item: item[0])
+        if 'search_after' in body:
+            after = _sort_key(dict(zip([next(iter(spec)) for spec in sort], body['search_after'])), sort)[1]
+            ranked = [item for item in ranked if item[0] > after]
+
+        fields = body.get('_source')
+        results = []
+        for _, values, id, document in ranked[:body.get('size', 10)]:
+            if isinstance(fields, list):
+                document = {field: document[field] for field in fields if field in document}
+            results.append({"_index": index, "_id": id, "_source": document, **({"sort": values} if sort else {})})
+        return self._json({"took": 0, "timed_out": False,
+                           "hits": {"total": {"value": len(hits), "relation": "eq"}, "hits": results}})
+
+    async def bulk(self, request: Request):
+        await self._begin('bulk')
+        lines = [json.loads(line) for line in (await request.body()).splitlines() if line.strip()]
+        items = []
+        position = 0
+        while position < len(lines):
+            op_type, meta = next(iter(lines[position].items()))
+            index, id = meta['_index'], meta.get('_id')
+            if op_type == 'delete':
+                found = self.indices.get(index, {}).pop(id, None) is not None
+                status_code, result = (200 if found else 404), {"_index": index, "_id": id,
+                                                                "result": "deleted" if found else "not_found"}
+                position += 1
+            else:
+                body = lines[position + 1]
+                position += 2
+                if op_type == 'update':
+                    status_code, result = self._update(index, id, body)
+                else:
+                    id = id or hashlib.sha1(f"{index}{position}{datetime.datetime.utcnow()}".encode()).hexdigest()
+                    status_code, result = self._write(index, id, body, create=op_type == 'create')
+            items.append({op_type: {**result, "status": status_code}})
+        errors = any(next(iter(item.values()))['status'] >= 300 for item in items)
+        return self._json({"took": 0, "errors": errors, "items": items})
+
+
+class SMTPSink:
+    """
+    Minimal plain-text SMTP server that accepts and counts every message.
+    """
+
+    def __init__(self):
+        self.messages = 0
+
+    async def handle(self, reader, writer):
+        writer.write(b"220 benchmark ESMTP\r\n")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line[:4].upper()
+                if command == b"EHLO":
+                    writer.write(b"250-benchmark\r\n250 SIZE 10485760\r\n")
+                elif command == b"DATA":
+                    writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                    await writer.drain()
+                    while (await reader.readline()) not in (b".\r\n", b""):
+                        pass
+                    self.messages += 1
+                    writer.write(b"250 OK\r\n")
+                elif command == b"QUIT":
+                    writer.write(b"221 Bye\r\n")
+                    break
+                else:
+                    writer.write(b"250 OK\r\n")
+                await writer.drain()
+        finally:
+            writer.close()
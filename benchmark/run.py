@@ -0,0 +1,288 @@
+# Offline load test of the API against local stand-ins for Google and Elasticsearch.
+# Run from the project root with:  python -m benchmark.run [--requests N] [--concurrency C] ...
+#
+# The app is started with uvicorn in a subprocess; fake Google, Elasticsearch and SMTP servers
+# run in this process. Each scenario reports latency percentiles, throughput and the number of
+# upstream calls it caused. Settings of the app (cache TTLs, rate limits, ...) can be overridden
+# through the environment as usual; only the credentials and upstream endpoints are set here.
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+
+import httpx
+import uvicorn
+
+from benchmark.fakes import FakeElasticsearch, FakeGoogle, SMTPSink
+
+HOST = "127.0.0.1"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[rank]
+
+
+class Upstreams:
+    """
+    Runs the fake Google, Elasticsearch and SMTP servers on their own event loop thread.
+    """
+
+    def __init__(self, google_latency, es_latency):
+        self.google = FakeGoogle(google_latency)
+        self.es = FakeElasticsearch(es_latency)
+        self.smtp = SMTPSink()
+        self.google_port, self.es_port, self.smtp_port = free_port(), free_port(), free_port()
+        self._servers = []
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result(timeout=30)
+
+    async def _start(self):
+        for app, port in ((self.google.app, self.google_port), (self.es.app, self.es_port)):
+            server = uvicorn.Server(uvicorn.Config(app, host=HOST, port=port, log_level="warning", access_log=False))
+            self._servers.append(server)
+            asyncio.ensure_future(server.serve())
+        self._smtp_server = await asyncio.start_server(self.smtp.handle, HOST, self.smtp_port)
+        while not all(server.started for server in self._servers):
+            await asyncio.sleep(0.05)
+
+    def stop(self):
+        async def _stop():
+            for server in self._servers:
+                server.should_exit = True
+            self._smtp_server.close()
+            await asyncio.sleep(0.2)
+        asyncio.run_coroutine_threadsafe(_stop(), self._loop).result(timeout=30)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def counts(self):
+        return Counter({**{f"google_{api}": n for api, n in self.google.calls.items()},
+                        **{f"es_{op}": n for op, n in self.es.calls.items()},
+                        "smtp_messages": self.smtp.messages})
+
+    def app_env(self):
+        google = f"http://{HOST}:{self.google_port}"
+        env = dict(os.environ)
+        env.update({
+            "GOOGLE_API_KEY": "benchmark",
+            "GOOGLE_GEOCODE_API_BASE_URL": f"{google}/geocode/json",
+            "GOOGLE_PLACES_API_BASE_URL": f"{google}/place/nearbysearch/json",
+            "GOOGLE_PLACE_DETAILS_API_BASE_URL": f"{google}/place/details/json",
+            "ES_HOST": f"http://{HOST}:{self.es_port}",
+            "ES_USERNAME": "benchmark",
+            "ES_PASSWORD": "benchmark",
+            "SECRET_KEY": "benchmark-secret-key-of-sufficient-length",
+            "ALGORITHM": "HS256",
+            "MAIL_HOST": HOST,
+            "MAIL_PORT": str(self.smtp_port),
+            "MAIL_USE_TLS": "false",
+            "MAIL_USE_AUTH": "false",
+            "MAIL_USERNAME": "benchmark@example.com",
+            "MAIL_PASSWORD": "benchmark",
+        })
+        return env
+
+
+def start_app(env, port, log_file):
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", HOST, "--port", str(port),
+         "--log-level", "warning", "--no-access-log"],
+        env=env, stdout=log_file, stderr=subprocess.STDOUT,
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"App exited during startup with code {process.returncode}")
+        try:
+            if httpx.get(f"http://{HOST}:{port}/health/ready", timeout=1).status_code == 200:
+                return process
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("App did not start within 60s")
+
+
+async def run_load(client, requests, concurrency):
+    """
+    Send (method, path, kwargs) requests with at most concurrency in flight.
+    Returns (latencies in ms, error count, wall time in s).
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = Counter()
+
+    async def send(method, path, kwargs):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, path, **kwargs)
+                await response.aread()
+                if response.status_code >= 400:
+                    errors[response.status_code] += 1
+                # Answered, but with part of the search area missing
+                elif "x-partial-results" in response.headers:
+                    errors["partial"] += 1
+            except httpx.HTTPError as e:
+                errors[type(e).__name__] += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send(*request) for request in requests))
+    return latencies, errors, time.perf_counter() - started
+
+
+def nearby(location, radius=1000):
+    return ("POST", "/maps/nearby_restaurants", {"json": {"location": location, "radius": radius}})
+
+
+def details(place_id):
+    return ("GET", f"/maps/restaurant_details/{place_id}", {})
+
+
+def signup(n):
+    return ("POST", "/signup", {"json": {"username": f"bench{n}", "email": f"bench{n}@example.com",
+                                         "password": f"password-{n}"}})
+
+
+def login(n):
+    return ("POST", "/login", {"json": {"email": f"bench{n}@example.com", "password": f"password-{n}"}})
+
+
+def scenarios(count):
+    """
+    Scenarios in run order; the warm ones replay what the cold ones just cached.
+    """
+    return [
+        ("nearby_cold", [nearby(f"Benchmark location {n}") for n in range(count)]),
+        ("nearby_warm", [nearby(f"Benchmark location {n}") for n in range(count)]),
+        ("nearby_hot_key", [nearby("Benchmark hot location") for _ in range(count)]),
+        # Wide searches are split into geohash tiles, fetched and cached one by one
+        ("nearby_wide_5km_cold", [nearby(f"Benchmark wide location {n}", 5000) for n in range(count)]),
+        ("nearby_wide_5km_warm", [nearby(f"Benchmark wide location {n}", 5000) for n in range(count)]),
+        ("nearby_wide_30km_cold", [nearby(f"Benchmark wider location {n}", 30000) for n in range(count)]),
+        ("nearby_wide_30km_warm", [nearby(f"Benchmark wider location {n}", 30000) for n in range(count)]),
+        ("details_cold", [details(f"fake_{n}_0") for n in range(count)]),
+        ("details_warm", [details(f"fake_{n}_0") for n in range(count)]),
+        ("signup", [signup(n) for n in range(count)]),
+        ("login", [login(n) for n in range(count)]),
+    ]
+
+
+async def run_scenarios(upstreams, base_url, count, concurrency, selected, settle):
+    results = []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        for name, requests in scenarios(count):
+            if selected and name not in selected:
+                continue
+            before = upstreams.counts()
+            latencies, errors, elapsed = await run_load(client, requests, concurrency)
+            # Let buffered cache writes reach the stand-in before the next scenario
+            await asyncio.sleep(settle)
+            upstream_calls = upstreams.counts()
+            upstream_calls.subtract(before)
+            latencies.sort()
+            results.append({
+                "scenario": name,
+                "requests": len(requests),
+                "errors": dict(errors),
+                "rps": round(len(requests) / elapsed, 1),
+                "p50_ms": round(percentile(latencies, 0.50), 1),
+                "p95_ms": round(percentile(latencies, 0.95), 1),
+                "p99_ms": round(percentile(latencies, 0.99), 1),
+                "upstream_calls": {key: n for key, n in sorted(upstream_calls.items()) if n},
+            })
+            print_result(results[-1])
+    return results
+
+
+def print_result(result):
+    errors = sum(result["errors"].values())
+    upstream = ", ".join(f"{key}={n}" for key, n in result["upstream_calls"].items()) or "-"
+    print(f"{result['scenario']:<22} {result['requests']:>6} req  {errors:>4} err  {result['rps']:>8} rps  "
+          f"p50 {result['p50_ms']:>8} ms  p95 {result['p95_ms']:>8} ms  p99 {result['p99_ms']:>8} ms  {upstream}",
+          flush=True)
+
+
+def compare(results, baseline_path, tolerance):
+    """
+    Compare against an earlier --output file. Returns the regressions found, as messages.
+    """
+    with open(baseline_path) as baseline_file:
+        baseline = {result["scenario"]: result for result in json.load(baseline_file)["results"]}
+    regressions = []
+    for result in results:
+        before = baseline.get(result["scenario"])
+        if before is None:
+            continue
+        if result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{result['scenario']}: p95 {before['p95_ms']} -> {result['p95_ms']} ms")
+        if result["rps"] < before["rps"] * (1 - tolerance):
+            regressions.append(f"{result['scenario']}: {before['rps']} -> {result['rps']} rps")
+        for key, n in result["upstream_calls"].items():
+            if key.startswith("google_") and n > before["upstream_calls"].get(key, 0):
+                regressions.append(f"{result['scenario']}: {key} {before['upstream_calls'].get(key, 0)} -> {n}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline latency and throughput benchmark.")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=20, help="requests in flight at once")
+    parser.add_argument("--google-latency", type=float, default=50, help="fake Google API latency (ms)")
+    parser.add_argument("--es-latency", type=float, default=2, help="fake Elasticsearch latency (ms)")
+    parser.add_argument("--scenario", action="append", help="run only these scenarios (repeatable)")
+    parser.add_argument("--settle", type=float, default=1.5,
+                        help="pause after each scenario so buffered writes land (s)")
+    parser.add_argument("--app-log", default=os.devnull, help="file receiving the app's output")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="fail if results regress against this earlier --output file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression against the baseline")
+    args = parser.parse_args()
+
+    upstreams = Upstreams(args.google_latency / 1000, args.es_latency / 1000)
+    upstreams.start()
+    port = free_port()
+    with open(args.app_log, "w") as log_file:
+        app = start_app(upstreams.app_env(), port, log_file)
+        try:
+            results = asyncio.run(run_scenarios(upstreams, f"http://{HOST}:{port}", args.requests,
+                                                args.concurrency, args.scenario, args.settle))
+        finally:
+            app.terminate()
+            app.wait(timeout=30)
+            upstreams.stop()
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({"settings": vars(args), "results": results}, output_file, indent=2)
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+from fastapi import APIRouter, Response
+import server_properties
+from helper import cache, es_repository, rate_limiter
+from helper.mail_queue import mail_queue
+from helper.write_buffer import write_buffer
+
+health_controller = APIRouter(prefix="/health")
+
+# Dependencies without which the service cannot answer requests; the others only degrade it
+CRITICAL_DEPENDENCIES = ("elasticsearch",)
+
+
+def _not_configured(subsystem):
+    missing = server_properties.missing_settings(subsystem)
+    if missing:
+        return {"status": "not configured", "missing": missing}
+    return None
+
+async def check_elasticsearch():
+    not_configured = _not_configured('elasticsearch')
+    if not_configured:
+        return not_configured
+    if not await es_repository.ping():
+        return {"status": "unavailable"}
+    return {"status": "ok", "write_buffer_pending": write_buffer.pending}
+
+def check_google():
+    not_configured = _not_configured('google')
+    if not_configured:
+        return not_configured
+    degraded = [api for api, limiter in rate_limiter.limiters.items() if limiter.degraded()]
+    if degraded:
+        # Low on budget or backing off: cached results are served instead of calling out
+        return {"status": "degraded", "apis": degraded}
+    return {"status": "ok"}
+
+async def check_cache():
+    # Without the shared cache lookups fall through to Elasticsearch, so this only degrades the service
+    backend = server_properties.CACHE_BACKEND
+    if not await cache.ping():
+        return {"status": "unavailable", "backend": backend}
+    return {"status": "ok", "backend": backend}
+
+def check_auth():
+    return _not_configured('auth') or {"status": "ok"}
+
+def check_mail():
+    not_configured = _not_configured('mail')
+    if not_configured:
+        return not_configured
+    return {"status": "ok" if mail_queue.running else "stopped"}
+
+@health_controller.get("/live")
+async def live():
+    # The process is up and serving requests; dependencies are checked by /health/ready
+    return {"status": "ok"}
+
+@health_controller.get("/ready")
+async def ready(response: Response):
+    checks = {
+        "elasticsearch": await check_elasticsearch(),
+        "google": check_google(),
+        "cache": await check_cache(),
+        "auth": check_auth(),
+        "mail": check_mail(),
+    }
+    is_ready = all(checks[name]["status"] == "ok" for name in CRITICAL_DEPENDENCIES)
+    if not is_ready:
+        response.status_code = 503
+    return {"status": "ready" if is_ready else "not ready", "checks": checks}
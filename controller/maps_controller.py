@@ -1,15 +1,20 @@
 import datetime
-from fastapi import APIRouter, HTTPException, Request
+import json
+import math
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from typing import List, Optional
 from service import maps_service
+from helper.auth import get_current_user_id, ensure_same_user
+from helper.rate_limiter import UpstreamRefused
 import server_properties
 import logger
 from datetime import timedelta
 
 
-log = logger.get_logger()
+log = logger.get_logger(__name__)
 
-api_key = server_properties.GOOGLE_API_KEY
 maps_controller = APIRouter(prefix="/maps")
 
 # Request body models
@@ -39,19 +44,47 @@ class ReviewRequest(BaseModel):
     rating: float
     review_text: str
 
+# Request body model for fetching many restaurant details at once
+class RestaurantDetailsBatchRequest(BaseModel):
+    restaurant_ids: List[str]
+
 # Request body model for querying user reviews
 class ReviewQueryRequest(BaseModel):
     restaurant_id: str
 
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+def upstream_refused(e):
+    # Google could not be asked: 429 while rate limited, 503 while out of budget or backing off
+    retry_after = str(max(math.ceil(e.retry_after), 1))
+    return HTTPException(status_code=429 if e.throttled else 503,
+                         detail="Restaurant data is temporarily unavailable, please retry later.",
+                         headers={"Retry-After": retry_after})
+
+async def ndjson_lines(items):
+    async for item in items:
+        yield json.dumps(item) + "\n"
+
 @maps_controller.post("/nearby_restaurants")
-async def nearby_restaurants(request: Request, data: LocationRequest):
-    log.info(f"Finding restaurants near {data.location}...")
+async def nearby_restaurants(request: Request, response: Response, data: LocationRequest):
+    log.info("Finding restaurants near %s...", data.location)
     if not data.location:
         raise HTTPException(status_code=400, detail="Location is required.")
-    
-    # Fetch new nearby restaurants from Google API
-    restaurants = maps_service.find_nearby_restaurants(api_key, data.location, data.radius, data.keyword)
-    
+
+    try:
+        # Opt-in streaming: one JSON object per line, cached results first, fresh ones as they arrive
+        if NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+            stream = await maps_service.open_nearby_restaurants_stream(data.location, data.radius, data.keyword)
+            return StreamingResponse(ndjson_lines(stream), media_type=NDJSON_MEDIA_TYPE)
+
+        # Fetch new nearby restaurants from Google API
+        restaurants, unavailable = await maps_service.find_nearby_restaurants(data.location, data.radius, data.keyword)
+    except UpstreamRefused as e:
+        raise upstream_refused(e)
+
+    # Some tiles of the search could not be fetched, so results may be missing from part of the area
+    if unavailable:
+        response.headers["X-Partial-Results"] = f"unavailable-tiles={unavailable}"
     if restaurants:
         return restaurants
     else:
@@ -59,24 +92,44 @@ async def nearby_restaurants(request: Request, data: LocationRequest):
 
 @maps_controller.get("/restaurant_details/{restaurant_id}")
 async def restaurant_details(restaurant_id: str):
-    log.info(f"Fetching details for restaurant ID: {restaurant_id}...")
+    log.info("Fetching details for restaurant ID: %s...", restaurant_id)
     
     # Fetch restaurant details from the service
-    details = maps_service.get_restaurant_details(api_key, restaurant_id)
+    try:
+        details = await maps_service.get_restaurant_details(restaurant_id)
+    except UpstreamRefused as e:
+        raise upstream_refused(e)
     
     return {'details': details}
+
+@maps_controller.post("/restaurant_details:batch")
+async def restaurant_details_batch(data: RestaurantDetailsBatchRequest):
+    log.info("Fetching details for %s restaurants...", len(data.restaurant_ids))
+    if not data.restaurant_ids:
+        raise HTTPException(status_code=400, detail="At least one restaurant ID is required.")
+    if len(data.restaurant_ids) > server_properties.MAX_DETAILS_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {server_properties.MAX_DETAILS_BATCH_SIZE} restaurant IDs are allowed per batch.")
+
+    details, unavailable = await maps_service.get_restaurant_details_batch(data.restaurant_ids)
+
+    # Ids whose details could not be fetched right now are listed so the client can retry them
+    if unavailable:
+        return {'details': details, 'unavailable': unavailable}
+    return {'details': details}
+
 @maps_controller.get("/restaurant_reviews/{restaurant_id}")
 async def restaurant_reviews(restaurant_id: str):
-    log.info(f"Fetching reviews for restaurant ID: {restaurant_id}...")
+    log.info("Fetching reviews for restaurant ID: %s...", restaurant_id)
     
     # Fetch restaurant details from the service
-    details = maps_service.fetch_restaurant_reviews(api_key, restaurant_id)
+    details = await maps_service.fetch_restaurant_reviews(restaurant_id)
     
     return {'details': details}
 
 @maps_controller.post("/add_favorite")
-async def add_favorite(data: FavoriteRequest):
-    log.info(f"Adding restaurant {data.restaurant_id} to favorites for user {data.user_id}...")
+async def add_favorite(data: FavoriteRequest, current_user_id: str = Depends(get_current_user_id)):
+    ensure_same_user(data.user_id, current_user_id)
+    log.info("Adding restaurant %s to favorites for user %s...", data.restaurant_id, data.user_id)
     
     # Create favorite data
     favorite_data = {
@@ -87,19 +140,22 @@ async def add_favorite(data: FavoriteRequest):
     }
     
     # Store favorite in Elasticsearch
-    response = maps_service.store_user_favorite(favorite_data)
+    response = await maps_service.store_user_favorite(favorite_data)
     
     return {"message": "Favorite added successfully", "response": response}
 
 @maps_controller.get("/user_favorites/{user_id}")
-async def user_favorites(user_id: str):
-    log.info(f"Fetching favorites for user ID: {user_id}...")
-    favorites = maps_service.fetch_user_favorites(user_id)
-    return {'favorites': favorites}
+async def user_favorites(user_id: str, size: int = Query(20, ge=1, le=server_properties.MAX_PAGE_SIZE),
+                         cursor: Optional[str] = None, current_user_id: str = Depends(get_current_user_id)):
+    ensure_same_user(user_id, current_user_id)
+    log.info("Fetching favorites for user ID: %s...", user_id)
+    favorites, next_cursor = await maps_service.fetch_user_favorites(user_id, size, cursor)
+    return {'favorites': favorites, 'next_cursor': next_cursor}
 
 @maps_controller.post("/add_review")
-async def add_review(data: ReviewRequest):
-    log.info(f"Adding review for restaurant {data.restaurant_id} by user {data.user_id}...")
+async def add_review(data: ReviewRequest, current_user_id: str = Depends(get_current_user_id)):
+    ensure_same_user(data.user_id, current_user_id)
+    log.info("Adding review for restaurant %s by user %s...", data.restaurant_id, data.user_id)
     
     # Validate rating
     if data.rating < 1 or data.rating > 5:
@@ -121,14 +177,21 @@ async def add_review(data: ReviewRequest):
     
     # Store review in Elasticsearch
     try:
-        response = maps_service.store_user_review(review_data)
+        response = await maps_service.store_user_review(review_data)
         return {"message": "Review added successfully", "response": response}
     except Exception as e:
         log.error(f"Error storing review: {str(e)}")
         raise HTTPException(status_code=500, detail="Error storing review in database.")
     
+@maps_controller.get("/restaurant_rating/{restaurant_id}")
+async def restaurant_rating(restaurant_id: str):
+    log.info("Fetching rating summary for restaurant ID: %s...", restaurant_id)
+    summary = await maps_service.get_rating_summary(restaurant_id)
+    return {'rating': summary}
+
 @maps_controller.get("/user_reviews")
-async def get_user_reviews(query: ReviewQueryRequest):
+async def get_user_reviews(query: ReviewQueryRequest, size: int = Query(20, ge=1, le=server_properties.MAX_PAGE_SIZE),
+                           cursor: Optional[str] = None):
     log.info("Fetching user reviews...")
 
     # Validate input: at least one of user_id or restaurant_id should be provided
@@ -138,14 +201,21 @@ async def get_user_reviews(query: ReviewQueryRequest):
     # Fetch user reviews based on user_id or restaurant_id
     try:
         if query.restaurant_id:
-            reviews = maps_service.fetch_reviews_given_by_users(query.restaurant_id)
+            reviews, next_cursor = await maps_service.fetch_reviews_by_restaurant(query.restaurant_id, size, cursor)
 
         if reviews:
-            return {"reviews": reviews}
+            return {"reviews": reviews, "next_cursor": next_cursor}
         else:
             return {"message": "No reviews found."}
+    except HTTPException:
+        raise
     except Exception as e:
         log.error(f"Error fetching reviews: {str(e)}")
         raise HTTPException(status_code=500, detail="Error fetching reviews from database.")
     
 
+
+@maps_controller.get("/upstream_quota")
+async def upstream_quota():
+    # Google API budget burn, throttling and degraded-mode counters, per API
+    return maps_service.get_upstream_quota_stats()
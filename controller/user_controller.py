@@ -2,6 +2,8 @@ from fastapi import APIRouter, HTTPException, Depends
 from pydantic import BaseModel
 from typing import Optional
 from service.user_service import UserService
+from helper.passwords import PasswordPoolBusy
+from helper.auth import get_current_user_id, ensure_same_user
 
 # Create router
 user_controller = APIRouter()
@@ -24,26 +26,40 @@ class UpdateModel(BaseModel):
 # Dependency to use the service
 user_service = UserService()
 
+def password_pool_busy():
+    # Password hashing is saturated; ask the client to back off instead of queueing indefinitely
+    return HTTPException(status_code=429, detail="Too many requests, please retry shortly.", headers={"Retry-After": "1"})
+
 @user_controller.post("/signup")
 async def signup(user: SignupModel):
-    result = user_service.signup(user.username, user.password, user.email)
+    try:
+        result = await user_service.signup(user.username, user.password, user.email)
+    except PasswordPoolBusy:
+        raise password_pool_busy()
     if result.get("success"):
-        return {"message": "Signup successful", "user-id": result.get("user_id")}
+        return {"message": "Signup successful", "user-id": result.get("user_id"), "token": result.get("token")}
     else:
         raise HTTPException(status_code=400, detail=result.get("error"))
 
 @user_controller.post("/login")
 async def login(user: LoginModel):
-    result = user_service.login(user.email, user.password)
+    try:
+        result = await user_service.login(user.email, user.password)
+    except PasswordPoolBusy:
+        raise password_pool_busy()
     #print(f"result in controller -> {result}")
     if result.get("success"):
-        return {"message": "Login successful", "result": result.get('result')}
+        return {"message": "Login successful", "result": result.get('result'), "token": result.get("token")}
     else:
         raise HTTPException(status_code=401, detail=result.get("error"))
 
 @user_controller.put("/update")
-async def update(user: UpdateModel, user_id: str):
-    result = user_service.update_user(user_id, user.username, user.password)
+async def update(user: UpdateModel, user_id: str, current_user_id: str = Depends(get_current_user_id)):
+    ensure_same_user(user_id, current_user_id)
+    try:
+        result = await user_service.update_user(user_id, user.username, user.password)
+    except PasswordPoolBusy:
+        raise password_pool_busy()
     if result.get("success"):
         return {"message": "User updated successfully"}
     else:
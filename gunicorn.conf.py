@@ -0,0 +1,47 @@
+# Production server: gunicorn managing several uvicorn worker processes.
+# Run from the project root with:  gunicorn -c gunicorn.conf.py app:app
+#
+# Every setting below can be overridden through the environment. Send SIGHUP to the gunicorn
+# master to replace the workers gracefully (new code and settings are picked up, requests in
+# flight are finished first); SIGTERM stops the server after the same graceful period.
+import os
+import shutil
+import tempfile
+
+bind = f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', '8080')}"
+
+# One event loop per core. Exported so every worker knows how many siblings share the
+# per-process limits (Google API budgets, bcrypt pool), see server_properties.WEB_CONCURRENCY
+workers = int(os.environ.setdefault('WEB_CONCURRENCY', str(os.cpu_count() or 1)))
+worker_class = 'uvicorn.workers.UvicornWorker'
+
+# Workers open their own HTTP, Elasticsearch and Redis connections and bcrypt pool in the app's
+# lifespan; none of them survive a fork, so the app is imported in each worker, not in the master
+preload_app = False
+
+# Seconds a worker gets to finish in-flight requests, flush queued mail and drain buffered writes
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+# Seconds of silence after which a stuck worker is killed and replaced
+timeout = int(os.environ.get('WORKER_TIMEOUT', 60))
+keepalive = int(os.environ.get('KEEPALIVE', 5))
+# Recycle workers after this many requests (0 = never), spread out so they do not restart together
+max_requests = int(os.environ.get('MAX_REQUESTS', 0))
+max_requests_jitter = int(os.environ.get('MAX_REQUESTS_JITTER', max_requests // 10))
+# Restart workers when the code changes; for development only
+reload = os.environ.get('GUNICORN_RELOAD', 'false').lower() in ('1', 'true', 'yes')
+
+# Prometheus metrics are recorded per worker in this directory and added up by /metrics.
+# It has to be set before the workers import prometheus_client.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'location-search-metrics'))
+
+
+def on_starting(server):
+    # Files left behind by an earlier run would be counted again
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,58 @@
+import hashlib
+import time
+
+import jwt
+from fastapi import Depends, HTTPException
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+
+import server_properties
+from helper import metrics
+from helper.cache import TTLCache
+
+bearer_scheme = HTTPBearer(auto_error=False)
+
+# Claims of tokens that already passed verification, keyed by token digest, kept until they expire
+token_cache = TTLCache(server_properties.TOKEN_CACHE_MAX_ENTRIES, server_properties.TOKEN_CACHE_MAX_TTL)
+metrics.register_cache('token', token_cache)
+
+
+def _unauthorized(detail):
+    return HTTPException(status_code=401, detail=detail, headers={"WWW-Authenticate": "Bearer"})
+
+
+def verify_token(token: str) -> dict:
+    """
+    Verify a JWT locally (signature and expiry) and return its claims. No Elasticsearch call is made.
+    """
+    key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    claims = token_cache.get(key)
+    if claims is not None and claims['exp'] > time.time():
+        return claims
+
+    try:
+        claims = jwt.decode(token, server_properties.SECRET_KEY, algorithms=[server_properties.ALGORITHM],
+                            options={"require": ["exp"]})
+    except jwt.ExpiredSignatureError:
+        raise _unauthorized("Token has expired")
+    except jwt.InvalidTokenError:
+        raise _unauthorized("Invalid token")
+    if not claims.get('user_id'):
+        raise _unauthorized("Invalid token")
+
+    token_cache.set(key, claims, ttl=min(claims['exp'] - time.time(), server_properties.TOKEN_CACHE_MAX_TTL))
+    return claims
+
+
+async def get_current_user_id(credentials: HTTPAuthorizationCredentials = Depends(bearer_scheme)) -> str:
+    """
+    FastAPI dependency returning the user_id of the bearer token on the request.
+    """
+    if credentials is None:
+        raise _unauthorized("Not authenticated")
+    return verify_token(credentials.credentials)['user_id']
+
+
+def ensure_same_user(user_id: str, current_user_id: str):
+    # Clients may only act on their own user_id
+    if user_id != current_user_id:
+        raise HTTPException(status_code=403, detail="Not allowed to access another user's data.")
@@ -0,0 +1,37 @@
+import asyncio
+
+import logger
+
+log = logger.get_logger(__name__)
+
+# Strong references to fire-and-forget tasks so they are not garbage collected mid-flight
+_tasks = set()
+
+
+def spawn(coro):
+    """
+    Run a coroutine in the background, off the request path.
+    """
+    task = asyncio.ensure_future(coro)
+    _tasks.add(task)
+    task.add_done_callback(_finished)
+    return task
+
+
+def _finished(task):
+    _tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log.error(f"Background task failed: {task.exception()!r}")
+
+
+async def drain(timeout=10.0):
+    """
+    Wait for outstanding background tasks on shutdown, cancelling any that overrun the timeout.
+    """
+    if not _tasks:
+        return
+    done, pending = await asyncio.wait(set(_tasks), timeout=timeout)
+    for task in pending:
+        task.cancel()
+    if pending:
+        log.warning(f"Cancelled {len(pending)} background tasks still running at shutdown")
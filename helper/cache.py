@@ -0,0 +1,202 @@
+import json
+import time
+from collections import OrderedDict
+
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+
+import server_properties
+import logger
+from helper import metrics
+
+log = logger.get_logger(__name__)
+
+# Shared Redis client, created on first use in each worker process
+_redis = None
+# Redis is bypassed until this time after it could not be reached
+_redis_down_until = 0.0
+
+
+class TTLCache:
+    """
+    Bounded in-process LRU cache whose entries expire after a time-to-live.
+    Keeps hit/miss counters so callers can report cache effectiveness.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        value, expires_at = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store a value, optionally with its own ttl, evicting the least recently used entries.
+        """
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+class MemoryCache:
+    """
+    Cache local to this process, behind the same async interface as RedisCache.
+    """
+    backend = 'memory'
+
+    def __init__(self, name, maxsize, ttl):
+        self.name = name
+        self._cache = TTLCache(maxsize, ttl)
+
+    async def get(self, key, default=None):
+        return self._cache.get(key, default)
+
+    async def set(self, key, value, ttl=None):
+        self._cache.set(key, value, ttl=ttl)
+
+    async def delete(self, key):
+        self._cache.delete(key)
+
+    def stats(self):
+        return {**self._cache.stats(), "backend": self.backend}
+
+
+class RedisCache:
+    """
+    Cache shared by all worker processes, kept in Redis or a Redis-compatible store.
+    Values are stored as JSON, so tuples come back as lists. Redis evicts by its own
+    maxmemory policy; an unreachable or slow Redis is treated as a miss.
+    """
+    backend = 'redis'
+
+    def __init__(self, name, ttl):
+        self.name = name
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key):
+        if isinstance(key, tuple):
+            key = ':'.join(str(part) for part in key)
+        return f"{server_properties.REDIS_KEY_PREFIX}{self.name}:{key}"
+
+    async def get(self, key, default=None):
+        raw = await _redis_call('get', self._key(key))
+        if raw is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return json.loads(raw)
+
+    async def set(self, key, value, ttl=None):
+        expires_in = self.ttl if ttl is None else ttl
+        await _redis_call('set', self._key(key), json.dumps(value), px=max(int(expires_in * 1000), 1))
+
+    async def delete(self, key):
+        await _redis_call('delete', self._key(key))
+
+    def stats(self):
+        return {"size": None, "maxsize": None, "hits": self.hits, "misses": self.misses, "backend": self.backend}
+
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(
+            server_properties.REDIS_URL,
+            socket_timeout=server_properties.REDIS_TIMEOUT,
+            socket_connect_timeout=server_properties.REDIS_TIMEOUT,
+            max_connections=server_properties.REDIS_MAX_CONNECTIONS,
+        )
+    return _redis
+
+
+async def _redis_call(operation, *args, **kwargs):
+    """
+    Run one Redis command, returning None when Redis fails or is being bypassed after a failure.
+    """
+    global _redis_down_until
+    if time.monotonic() < _redis_down_until:
+        return None
+    try:
+        with metrics.upstream_call('redis', operation):
+            return await getattr(get_redis(), operation)(*args, **kwargs)
+    except RedisError as e:
+        _redis_down_until = time.monotonic() + server_properties.REDIS_RETRY_INTERVAL
+        log.warning(f"Redis {operation} failed, bypassing the shared cache for "
+                    f"{server_properties.REDIS_RETRY_INTERVAL}s: {e}")
+        return None
+
+
+async def increment(name, ttl):
+    """
+    Add one to the Redis counter name, which expires ttl seconds after its first increment.
+    Returns the new count, or None when Redis cannot be reached.
+    """
+    key = f"{server_properties.REDIS_KEY_PREFIX}{name}"
+    count = await _redis_call('incr', key)
+    if count == 1:
+        await _redis_call('expire', key, ttl)
+    return count
+
+
+def create_cache(name, maxsize, ttl):
+    """
+    Create the cache named name in the backend selected by CACHE_BACKEND.
+    maxsize only bounds the in-process backend.
+    """
+    if server_properties.CACHE_BACKEND == 'redis':
+        return RedisCache(name, ttl)
+    if server_properties.CACHE_BACKEND == 'memory':
+        return MemoryCache(name, maxsize, ttl)
+    raise ValueError(f"Unknown CACHE_BACKEND {server_properties.CACHE_BACKEND!r}, expected 'memory' or 'redis'")
+
+
+async def ping():
+    """
+    True when the shared cache answers, or when caches are in-process.
+    """
+    if server_properties.CACHE_BACKEND != 'redis':
+        return True
+    try:
+        return await get_redis().ping()
+    except RedisError as e:
+        log.warning(f"Redis ping failed: {e}")
+        return False
+
+
+async def close():
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
+        log.info("Closed Redis client")
@@ -0,0 +1,252 @@
+from elasticsearch import AsyncElasticsearch, ApiError, ConflictError, NotFoundError, TransportError
+from elasticsearch.helpers import async_bulk, async_scan, async_streaming_bulk
+
+import server_properties
+import logger
+from helper import metrics
+
+log = logger.get_logger(__name__)
+
+# Index names used across the services
+# Restaurants and details are versioned like users: the legacy restaurants and restaurants_details
+# indices were dynamically mapped, and mapping location as geo_point in place fails when any existing
+# field conflicts. Both only cache Google data, so the new indices fill up again as searches come in.
+RESTAURANTS_INDEX = "restaurants_v2"
+RESTAURANT_COVERAGE_INDEX = "restaurant_coverage"
+RESTAURANT_DETAILS_INDEX = "restaurant_details_v2"
+RESTAURANT_REVIEWS_INDEX = "restaurant_reviews"
+LEGACY_USER_REVIEWS_INDEX = "user_reviews"
+USER_REVIEWS_INDEX = "user_reviews_v2"
+LEGACY_USER_FAVORITES_INDEX = "user_favorites"
+USER_FAVORITES_INDEX = "user_favorites_v2"
+RESTAURANT_RATINGS_INDEX = "restaurant_ratings"
+LEGACY_USERS_INDEX = "users"
+USERS_INDEX = "users_v2"
+USER_IDS_INDEX = "user_ids"
+GEOCODE_CACHE_INDEX = "geocode_cache"
+
+# Explicit mappings for indices whose fields are queried by type (geo, keyword, date)
+INDEX_MAPPINGS = {
+    RESTAURANTS_INDEX: {
+        "properties": {
+            "location": {"type": "geo_point"},
+            "keyword": {"type": "keyword"},
+            "rating": {"type": "float"},
+            "fetched_at": {"type": "date"},
+        }
+    },
+    RESTAURANT_COVERAGE_INDEX: {
+        "properties": {
+            "center": {"type": "geo_point"},
+            "radius": {"type": "integer"},
+            "geohash": {"type": "keyword"},
+            "keyword": {"type": "keyword"},
+            "complete": {"type": "boolean"},
+            "fetched_at": {"type": "date"},
+        }
+    },
+    # Users are keyed by normalised email; user_ids maps user_id back to that email
+    USERS_INDEX: {
+        "properties": {
+            "user_id": {"type": "keyword"},
+            "email": {"type": "keyword"},
+            "username": {"type": "keyword"},
+            "password": {"type": "keyword", "index": False},
+            "created_at": {"type": "date"},
+        }
+    },
+    USER_IDS_INDEX: {
+        "properties": {
+            "email": {"type": "keyword"},
+        }
+    },
+    # Favorites and reviews are filtered by keyword ids and paged by date
+    USER_FAVORITES_INDEX: {
+        "properties": {
+            "favorite_id": {"type": "keyword"},
+            "user_id": {"type": "keyword"},
+            "restaurant_id": {"type": "keyword"},
+            "added_at": {"type": "date"},
+        }
+    },
+    USER_REVIEWS_INDEX: {
+        "properties": {
+            "review_id": {"type": "keyword"},
+            "user_id": {"type": "keyword"},
+            "restaurant_id": {"type": "keyword"},
+            "rating": {"type": "float"},
+            "previous_rating": {"type": "float", "index": False},
+            "review_text": {"type": "text"},
+            "created_at": {"type": "date"},
+        }
+    },
+    # One rating aggregate per restaurant; the ids of its last few writes are stored but not indexed
+    RESTAURANT_RATINGS_INDEX: {
+        "properties": {
+            "restaurant_id": {"type": "keyword"},
+            "count": {"type": "long"},
+            "sum": {"type": "double"},
+            "histogram": {"type": "object"},
+            "recent": {"type": "keyword", "index": False},
+            "updated_at": {"type": "date"},
+        }
+    },
+    # Details are stored whole for retrieval by id; only the cache metadata is indexed
+    RESTAURANT_DETAILS_INDEX: {
+        "dynamic": False,
+        "properties": {
+            "cached_at": {"type": "date"},
+        }
+    },
+    GEOCODE_CACHE_INDEX: {
+        "properties": {
+            "address": {"type": "keyword"},
+            "latitude": {"type": "double"},
+            "longitude": {"type": "double"},
+            "cached_at": {"type": "date"},
+        }
+    },
+}
+
+# Shared async client: owns the connection pool and retry policy for every ES call
+_client = None
+
+
+def get_client():
+    """
+    Return the shared AsyncElasticsearch client, creating it on first use.
+    """
+    global _client
+    if _client is None:
+        _client = AsyncElasticsearch(
+            hosts=[server_properties.ES_HOST],
+            basic_auth=(server_properties.ES_USER, server_properties.ES_PASSWORD),
+            connections_per_node=server_properties.ES_CONNECTIONS_PER_NODE,
+            request_timeout=server_properties.ES_REQUEST_TIMEOUT,
+            max_retries=server_properties.ES_MAX_RETRIES,
+            retry_on_timeout=True,
+        )
+        log.info("Connected to Elasticsearch")
+    return _client
+
+
+async def search(index, body, **kwargs):
+    with metrics.upstream_call('es', 'search'):
+        return await get_client().search(index=index, body=body, **kwargs)
+
+
+async def index_document(index, document, id=None, **kwargs):
+    with metrics.upstream_call('es', 'index'):
+        return await get_client().index(index=index, id=id, document=document, **kwargs)
+
+
+async def create_document(index, id, document, **kwargs):
+    """
+    Index a document only if the id is not taken yet; raises ConflictError otherwise.
+    """
+    with metrics.upstream_call('es', 'create', expected=(ConflictError,)):
+        return await get_client().create(index=index, id=id, document=document, **kwargs)
+
+
+async def get_document(index, id, **kwargs):
+    """
+    Fetch a document's _source by id, or None when it does not exist.
+    """
+    try:
+        with metrics.upstream_call('es', 'get', expected=(NotFoundError,)):
+            response = await get_client().get(index=index, id=id, **kwargs)
+    except NotFoundError:
+        return None
+    return response['_source']
+
+
+async def mget_documents(index, ids, **kwargs):
+    """
+    Fetch many documents by id in one request, returning {id: _source} for those found.
+    """
+    if not ids:
+        return {}
+    with metrics.upstream_call('es', 'mget'):
+        response = await get_client().mget(index=index, ids=list(ids), **kwargs)
+    return {doc['_id']: doc['_source'] for doc in response['docs'] if doc.get('found')}
+
+
+async def update_document(index, id, body, **kwargs):
+    with metrics.upstream_call('es', 'update', expected=(NotFoundError,)):
+        return await get_client().update(index=index, id=id, body=body, **kwargs)
+
+
+async def delete_document(index, id, **kwargs):
+    """
+    Delete a document by id; a document that does not exist is left as is.
+    """
+    try:
+        with metrics.upstream_call('es', 'delete', expected=(NotFoundError,)):
+            await get_client().delete(index=index, id=id, **kwargs)
+    except NotFoundError:
+        pass
+
+
+async def bulk(actions, **kwargs):
+    """
+    Run a batch of bulk actions, returning (success_count, errors).
+    """
+    with metrics.upstream_call('es', 'bulk'):
+        return await async_bulk(get_client(), actions, **kwargs)
+
+
+async def bulk_results(actions, **kwargs):
+    """
+    Run a batch of bulk actions, returning one (ok, item) pair per action, in the order given.
+    """
+    with metrics.upstream_call('es', 'bulk'):
+        return [result async for result in async_streaming_bulk(get_client(), actions, **kwargs)]
+
+
+async def index_exists(index):
+    return bool(await get_client().indices.exists(index=index))
+
+
+async def scan(index, query=None, **kwargs):
+    """
+    Iterate over every hit matching a query, for migrations and other full-index passes.
+    """
+    async for hit in async_scan(get_client(), index=index, query=query, **kwargs):
+        yield hit
+
+
+async def ping(timeout=2.0):
+    """
+    Return True when the cluster answers within timeout seconds.
+    """
+    try:
+        return bool(await get_client().options(request_timeout=timeout).ping())
+    except (ApiError, TransportError):
+        return False
+
+
+async def ensure_indices():
+    """
+    Create missing indices with their mappings, or add new fields to existing ones.
+    """
+    client = get_client()
+    for index, mappings in INDEX_MAPPINGS.items():
+        try:
+            if await client.indices.exists(index=index):
+                await client.indices.put_mapping(index=index, **mappings)
+            else:
+                await client.indices.create(index=index, mappings=mappings)
+                log.info(f"Created index {index}")
+        except ApiError as e:
+            log.warning(f"Could not apply mapping for index {index}: {e}")
+
+
+async def close():
+    """
+    Close the shared client and release pooled connections.
+    """
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+        log.info("Closed Elasticsearch client")
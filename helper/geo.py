@@ -0,0 +1,149 @@
+import math
+from collections import namedtuple
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    """
+    Great-circle distance in metres between two (lat, lng) points.
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = math.radians(lat2 - lat1)
+    d_lambda = math.radians(lng2 - lng1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def circle_contains(outer_lat, outer_lng, outer_radius, lat, lng, radius):
+    """
+    True when the circle (lat, lng, radius) lies entirely inside the outer circle.
+    """
+    return haversine_m(outer_lat, outer_lng, lat, lng) + radius <= outer_radius
+
+
+# Geohash tiling -------------------------------------------------------------
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+MAX_GEOHASH_PRECISION = 9
+
+Tile = namedtuple('Tile', ['geohash', 'latitude', 'longitude', 'radius'])
+
+
+def geohash_encode(latitude, longitude, precision):
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    geohash, bits, bit_count, even = [], 0, 0, True
+    while len(geohash) < precision:
+        rng, value = (lng_range, longitude) if even else (lat_range, latitude)
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            rng[0] = mid
+        else:
+            bits = bits << 1
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(_BASE32[bits])
+            bits, bit_count = 0, 0
+    return ''.join(geohash)
+
+
+def geohash_bbox(geohash):
+    """
+    Bounding box of a geohash cell as (min_lat, min_lng, max_lat, max_lng).
+    """
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        value = _BASE32.index(char)
+        for shift in range(4, -1, -1):
+            rng = lng_range if even else lat_range
+            mid = (rng[0] + rng[1]) / 2
+            if (value >> shift) & 1:
+                rng[0] = mid
+            else:
+                rng[1] = mid
+            even = not even
+    return lat_range[0], lng_range[0], lat_range[1], lng_range[1]
+
+
+def _cell_size_deg(precision):
+    bits = 5 * precision
+    lat_bits, lng_bits = bits // 2, bits - bits // 2
+    return 180.0 / (2 ** lat_bits), 360.0 / (2 ** lng_bits)
+
+
+def _circle_bbox(latitude, longitude, radius):
+    d_lat = math.degrees(radius / EARTH_RADIUS_M)
+    d_lng = math.degrees(radius / (EARTH_RADIUS_M * max(math.cos(math.radians(latitude)), 1e-6)))
+    return (max(latitude - d_lat, -90.0), longitude - d_lng,
+            min(latitude + d_lat, 90.0), longitude + d_lng)
+
+
+def _distance_to_bbox(latitude, longitude, bbox):
+    min_lat, min_lng, max_lat, max_lng = bbox
+    nearest_lat = min(max(latitude, min_lat), max_lat)
+    nearest_lng = min(max(longitude, min_lng), max_lng)
+    return haversine_m(latitude, longitude, nearest_lat, nearest_lng)
+
+
+def _cover_cells(latitude, longitude, radius, precision, bbox):
+    min_lat, min_lng, max_lat, max_lng = bbox
+    cell_lat, cell_lng = _cell_size_deg(precision)
+    tiles = {}
+    lat = min_lat
+    while lat <= max_lat + cell_lat:
+        lng = min_lng
+        while lng <= max_lng + cell_lng:
+            geohash = geohash_encode(min(lat, max_lat), ((min(lng, max_lng) + 180.0) % 360.0) - 180.0, precision)
+            if geohash not in tiles:
+                cell = geohash_bbox(geohash)
+                if _distance_to_bbox(latitude, longitude, cell) <= radius:
+                    center_lat, center_lng = (cell[0] + cell[2]) / 2, (cell[1] + cell[3]) / 2
+                    tile_radius = math.ceil(haversine_m(cell[0], cell[1], cell[2], cell[3]) / 2)
+                    tiles[geohash] = Tile(geohash, center_lat, center_lng, tile_radius)
+            lng += cell_lng
+        lat += cell_lat
+    return list(tiles.values())
+
+
+def _nearest_cells(latitude, longitude, radius, precision, count):
+    # Only the cells near the centre are enumerated: a circle this wide holds well over count of them
+    cell_lat, cell_lng = _cell_size_deg(precision)
+    diagonal = haversine_m(latitude, longitude, latitude + cell_lat, longitude + cell_lng)
+    inner = min(radius, (math.isqrt(count) + 2) * diagonal)
+    tiles = _cover_cells(latitude, longitude, inner, precision, _circle_bbox(latitude, longitude, inner))
+    tiles.sort(key=lambda tile: haversine_m(latitude, longitude, tile.latitude, tile.longitude))
+    return tiles[:count]
+
+
+def geohash_tiles(latitude, longitude, radius, max_tiles, max_tile_radius):
+    """
+    Cover a search circle with geohash cells, each returned as the circle circumscribing it.
+    Uses the finest precision that keeps the tile count within max_tiles, among those whose
+    tiles are no wider than max_tile_radius. When every such precision needs more cells, the
+    widest cells that fit are used and only the max_tiles of them nearest the centre are returned.
+    """
+    bbox = _circle_bbox(latitude, longitude, radius)
+    min_lat, min_lng, max_lat, max_lng = bbox
+    best = []
+    for precision in range(1, MAX_GEOHASH_PRECISION + 1):
+        cell_lat, cell_lng = _cell_size_deg(precision)
+        # The cells have to add up to at least the circle's area; do not enumerate them all when
+        # that is more than max_tiles
+        capped = math.pi * (max_lat - min_lat) * (max_lng - min_lng) / 4 > max_tiles * cell_lat * cell_lng
+        if not capped:
+            tiles = _cover_cells(latitude, longitude, radius, precision, bbox)
+            capped = len(tiles) > max_tiles
+        # Finer precisions only need more tiles
+        if capped and best:
+            return best
+        if capped:
+            tiles = _nearest_cells(latitude, longitude, radius, precision, max_tiles)
+        if max(tile.radius for tile in tiles) <= max_tile_radius:
+            if capped:
+                return tiles
+            best = tiles
+    return best
@@ -0,0 +1,64 @@
+import asyncio
+from urllib.parse import urlsplit
+
+import httpx
+
+import server_properties
+import logger
+
+log = logger.get_logger(__name__)
+
+# Shared async client: one keep-alive connection pool for every outbound Google call
+_client = None
+# Per-host semaphores capping the number of in-flight requests to a single upstream
+_host_limits = {}
+
+
+def get_client():
+    """
+    Return the shared httpx.AsyncClient, creating it on first use.
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=server_properties.HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=server_properties.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=server_properties.HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(
+                server_properties.HTTP_TIMEOUT,
+                connect=server_properties.HTTP_CONNECT_TIMEOUT,
+            ),
+            verify=server_properties.HTTP_VERIFY_SSL,
+        )
+        log.info("Created shared HTTP client")
+    return _client
+
+
+def _host_semaphore(url):
+    host = urlsplit(url).netloc
+    semaphore = _host_limits.get(host)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(server_properties.HTTP_MAX_CONCURRENCY_PER_HOST)
+        _host_limits[host] = semaphore
+    return semaphore
+
+
+async def get(url, params=None):
+    """
+    Issue a GET through the shared pool, respecting the per-host concurrency limit.
+    """
+    async with _host_semaphore(url):
+        return await get_client().get(url, params=params)
+
+
+async def close():
+    """
+    Close the shared client and release pooled connections.
+    """
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+        log.info("Closed shared HTTP client")
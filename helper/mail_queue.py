@@ -0,0 +1,162 @@
+import asyncio
+import smtplib
+
+import server_properties
+import logger
+from helper import background
+
+log = logger.get_logger(__name__)
+
+
+class SMTPConnection:
+    """
+    A persistent, lazily (re)opened SMTP session. Used from worker threads only.
+    """
+
+    def __init__(self):
+        self._server = None
+
+    def _connect(self):
+        server = smtplib.SMTP(server_properties.MAIL_HOST, server_properties.MAIL_PORT,
+                              timeout=server_properties.MAIL_TIMEOUT)
+        if server_properties.MAIL_USE_TLS:
+            server.starttls()
+        if server_properties.MAIL_USE_AUTH:
+            server.login(server_properties.MAIL_USERNAME, server_properties.MAIL_PASSWORD)
+        self._server = server
+
+    def send(self, message):
+        if self._server is None:
+            self._connect()
+        try:
+            self._server.send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            # The server dropped an idle session; reconnect once and resend
+            self._server = None
+            self._connect()
+            self._server.send_message(message)
+
+    def send_batch(self, messages):
+        """
+        Send messages over the open session, returning the (message, error) pairs that failed.
+        """
+        failed = []
+        for message in messages:
+            try:
+                self.send(message)
+            except (smtplib.SMTPException, OSError) as e:
+                failed.append((message, e))
+                self.close()
+        return failed
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._server = None
+
+
+class MailQueue:
+    """
+    Outbound mail queue drained by a pool of workers, each holding a persistent SMTP session.
+    Workers send in batches and retry failed messages with exponential backoff.
+    """
+
+    def __init__(self, workers, batch_size, max_retries, retry_backoff, idle_timeout, maxsize):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.idle_timeout = idle_timeout
+        self.maxsize = maxsize
+        self._queue = None
+        self._tasks = []
+
+    @property
+    def running(self):
+        return self._queue is not None
+
+    async def start(self):
+        self._queue = asyncio.Queue(self.maxsize)
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+        log.info(f"Started mail queue with {self.workers} workers")
+
+    def enqueue(self, message, attempt=0):
+        """
+        Queue a message for delivery without waiting. Returns False if it had to be dropped.
+        """
+        if self._queue is None:
+            log.error("Mail queue is not running; dropping message")
+            return False
+        try:
+            self._queue.put_nowait((message, attempt))
+            return True
+        except asyncio.QueueFull:
+            log.error("Mail queue is full; dropping message")
+            return False
+
+    async def stop(self, timeout=10.0):
+        """
+        Wait for queued messages to be sent, then stop the workers.
+        """
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            log.warning(f"Mail queue stopped with {self._queue.qsize()} messages unsent")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    async def _worker(self):
+        connection = SMTPConnection()
+        try:
+            while True:
+                try:
+                    first = await asyncio.wait_for(self._queue.get(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    # Nothing to send for a while; don't hold the SMTP session open
+                    await asyncio.to_thread(connection.close)
+                    continue
+
+                batch = [first]
+                while len(batch) < self.batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+
+                attempts = {id(message): attempt for message, attempt in batch}
+                try:
+                    failed = await asyncio.to_thread(connection.send_batch, [message for message, _ in batch])
+                    for message, error in failed:
+                        self._retry(message, attempts[id(message)], error)
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+        finally:
+            connection.close()
+
+    def _retry(self, message, attempt, error):
+        if attempt >= self.max_retries:
+            log.error(f"Giving up on mail to {message['To']} after {attempt + 1} attempts: {error}")
+            return
+        delay = self.retry_backoff * (2 ** attempt)
+        log.warning(f"Mail to {message['To']} failed ({error}); retrying in {delay:.1f}s")
+        background.spawn(self._requeue_later(message, attempt + 1, delay))
+
+    async def _requeue_later(self, message, attempt, delay):
+        await asyncio.sleep(delay)
+        self.enqueue(message, attempt)
+
+
+mail_queue = MailQueue(
+    workers=server_properties.MAIL_WORKERS,
+    batch_size=server_properties.MAIL_BATCH_SIZE,
+    max_retries=server_properties.MAIL_MAX_RETRIES,
+    retry_backoff=server_properties.MAIL_RETRY_BACKOFF,
+    idle_timeout=server_properties.MAIL_IDLE_TIMEOUT,
+    maxsize=server_properties.MAIL_QUEUE_SIZE,
+)
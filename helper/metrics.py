@@ -0,0 +1,269 @@
+import asyncio
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest,
+                               multiprocess)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, REGISTRY
+
+import server_properties
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'Time to handle an API request.',
+    ['method', 'endpoint', 'status'], buckets=LATENCY_BUCKETS)
+PHASE_SECONDS = Histogram(
+    'request_phase_duration_seconds', 'Time spent in one step of handling a request (geocode, ranking, ...).',
+    ['phase'], buckets=LATENCY_BUCKETS)
+UPSTREAM_SECONDS = Histogram(
+    'upstream_request_duration_seconds', 'Time spent waiting on an upstream call.',
+    ['upstream', 'operation'], buckets=LATENCY_BUCKETS)
+UPSTREAM_ERRORS = Counter(
+    'upstream_errors_total', 'Upstream calls that failed or returned an error status.',
+    ['upstream', 'operation'])
+CACHE_LOOKUPS = Counter(
+    'cache_lookups_total', 'Lookups in the Elasticsearch-backed caches, by result (fresh, stale, expired, hit, miss).',
+    ['cache', 'result'])
+PASSWORD_HASH_SECONDS = Histogram(
+    'password_hash_duration_seconds', 'Time for a bcrypt operation, including its wait for a worker process.',
+    ['operation'], buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+
+# Per-request step durations, reported back to the client in the Server-Timing header
+_timings = contextvars.ContextVar('timings', default=None)
+
+
+@contextmanager
+def timed(phase, histogram=None, *labels):
+    """
+    Time the block: observe it in histogram (PHASE_SECONDS by default) and add it to the
+    current request's Server-Timing entry named phase.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        if histogram is None:
+            PHASE_SECONDS.labels(phase).observe(elapsed)
+        else:
+            histogram.labels(*labels).observe(elapsed)
+        timings = _timings.get()
+        if timings is not None:
+            total, count = timings.get(phase, (0.0, 0))
+            timings[phase] = (total + elapsed, count + 1)
+
+
+@contextmanager
+def upstream_call(upstream, operation, expected=()):
+    """
+    Time an upstream call as '<upstream>_<operation>' and count it as an error if it raises
+    anything but the expected exceptions (such as a not-found on a get).
+    """
+    try:
+        with timed(f"{upstream}_{operation}", UPSTREAM_SECONDS, upstream, operation):
+            yield
+    except expected:
+        raise
+    except Exception:
+        UPSTREAM_ERRORS.labels(upstream, operation).inc()
+        raise
+
+
+def upstream_error(upstream, operation):
+    UPSTREAM_ERRORS.labels(upstream, operation).inc()
+
+
+def cache_lookup(cache, result, count=1):
+    if count:
+        CACHE_LOOKUPS.labels(cache, result).inc(count)
+
+
+def _server_timing(timings, total):
+    entries = []
+    for phase, (elapsed, count) in timings.items():
+        description = f';desc="x{count}"' if count > 1 else ''
+        entries.append(f"{phase}{description};dur={elapsed * 1000:.1f}")
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording request latency and adding a Server-Timing header that breaks
+    the request down into the steps timed with timed() / upstream_call() while handling it.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        timings = {}
+        token = _timings.set(timings)
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_with_timing(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+                headers = list(message.get('headers', []))
+                headers.append((b'server-timing', _server_timing(timings, time.perf_counter() - started).encode()))
+                message = {**message, 'headers': headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _timings.reset(token)
+            endpoint = scope.get('endpoint')
+            REQUEST_SECONDS.labels(scope['method'], getattr(endpoint, '__name__', 'unmatched'),
+                                   str(status[0])).observe(time.perf_counter() - started)
+
+
+def _multiprocess():
+    # Set by gunicorn.conf.py when the app runs in several worker processes
+    return 'PROMETHEUS_MULTIPROC_DIR' in os.environ
+
+
+_HELP = {
+    'memory_cache_hits': 'Hits in the application caches (in-process or Redis).',
+    'memory_cache_misses': 'Misses in the application caches (in-process or Redis).',
+    'memory_cache_entries': 'Entries held by the in-process caches.',
+    'google_api_budget_used': 'Google API calls made today.',
+    'google_api_budget_remaining': 'Google API calls left in today\'s budget.',
+    'google_api_budget_burn_per_hour': 'Average Google API calls per hour today.',
+    'google_api_degraded': '1 while cached data is preferred over calling out.',
+}
+
+# With several worker processes a scrape reaches only one of them, so instead of the collector
+# below every worker writes these to the shared directory (see publish_worker_stats) and render()
+# reads them all. Caches are added up; each live worker reports its own view of the Google budgets
+# (its share, or the shared count with CACHE_BACKEND=redis) under its pid.
+_WORKER_CACHE_HITS = Counter('memory_cache_hits', _HELP['memory_cache_hits'], ['cache'], registry=None)
+_WORKER_CACHE_MISSES = Counter('memory_cache_misses', _HELP['memory_cache_misses'], ['cache'], registry=None)
+_WORKER_CACHE_ENTRIES = Gauge('memory_cache_entries', _HELP['memory_cache_entries'], ['cache'],
+                              registry=None, multiprocess_mode='livesum')
+_WORKER_BUDGET = {
+    name: Gauge(name, _HELP[name], ['api'], registry=None, multiprocess_mode='liveall')
+    for name in ('google_api_budget_used', 'google_api_budget_remaining', 'google_api_budget_burn_per_hour',
+                 'google_api_degraded')
+}
+
+
+class _StatsCollector:
+    """
+    Exposes cache counters and Google API budgets, read at scrape time (or published
+    periodically by each worker in multiprocess mode).
+    """
+
+    def __init__(self):
+        self.caches = {}
+        self.quota_stats = None
+        # Cache counters already added to the shared counters, by cache name
+        self._published = {}
+
+    def _budgets(self):
+        for api, stats in self.quota_stats().items():
+            yield api, {
+                'google_api_budget_used': stats['used_today'],
+                'google_api_budget_remaining': stats['remaining'],
+                'google_api_budget_burn_per_hour': stats['burn_per_hour'],
+                'google_api_degraded': int(stats['degraded']),
+            }
+
+    def collect(self):
+        hits = CounterMetricFamily('memory_cache_hits', _HELP['memory_cache_hits'], labels=['cache'])
+        misses = CounterMetricFamily('memory_cache_misses', _HELP['memory_cache_misses'], labels=['cache'])
+        entries = GaugeMetricFamily('memory_cache_entries', _HELP['memory_cache_entries'], labels=['cache'])
+        for name, cache in self.caches.items():
+            stats = cache.stats()
+            hits.add_metric([name], stats['hits'])
+            misses.add_metric([name], stats['misses'])
+            if stats['size'] is not None:
+                entries.add_metric([name], stats['size'])
+        yield from (hits, misses, entries)
+
+        if self.quota_stats is None:
+            return
+        budget = {name: GaugeMetricFamily(name, _HELP[name], labels=['api']) for name in _WORKER_BUDGET}
+        for api, values in self._budgets():
+            for name, value in values.items():
+                if value is not None:
+                    budget[name].add_metric([api], value)
+        yield from budget.values()
+
+    def publish(self):
+        for name, cache in self.caches.items():
+            stats = cache.stats()
+            hits, misses = self._published.get(name, (0, 0))
+            # Counters only go up: a cache whose counts were reset starts over from zero
+            _WORKER_CACHE_HITS.labels(name).inc(stats['hits'] - hits if stats['hits'] >= hits else stats['hits'])
+            _WORKER_CACHE_MISSES.labels(name).inc(
+                stats['misses'] - misses if stats['misses'] >= misses else stats['misses'])
+            self._published[name] = (stats['hits'], stats['misses'])
+            if stats['size'] is not None:
+                _WORKER_CACHE_ENTRIES.labels(name).set(stats['size'])
+        if self.quota_stats is None:
+            return
+        for api, values in self._budgets():
+            for name, value in values.items():
+                if value is not None:
+                    _WORKER_BUDGET[name].labels(api).set(value)
+
+
+_collector = _StatsCollector()
+if not _multiprocess():
+    REGISTRY.register(_collector)
+_publish_task = None
+
+
+async def _publish_loop():
+    while True:
+        _collector.publish()
+        await asyncio.sleep(server_properties.METRICS_PUBLISH_INTERVAL)
+
+
+async def start_publishing():
+    """
+    In multiprocess mode, write this worker's cache and budget stats to the shared directory
+    every METRICS_PUBLISH_INTERVAL seconds.
+    """
+    global _publish_task
+    if _multiprocess():
+        _publish_task = asyncio.ensure_future(_publish_loop())
+
+
+async def stop_publishing():
+    global _publish_task
+    if _publish_task is not None:
+        _publish_task.cancel()
+        await asyncio.gather(_publish_task, return_exceptions=True)
+        _publish_task = None
+        _collector.publish()
+
+
+def register_cache(name, cache):
+    """
+    Report a cache's hits, misses and size (when it knows it) under the given name.
+    """
+    _collector.caches[name] = cache
+
+
+def register_quota_stats(stats):
+    _collector.quota_stats = stats
+
+
+def render():
+    if not _multiprocess():
+        return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+    # Every worker writes its metrics to the shared directory and they are added up here;
+    # the worker being scraped first brings its own stats up to date
+    _collector.publish()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -7,15 +7,34 @@ import sys
 # Add the project root to the Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import server_properties
+import logger
+from helper.mail_queue import mail_queue
 
+log = logger.get_logger(__name__)
 
-def send_notification(subject, body, to_email):
+
+def build_message(subject, body, to_email):
     msg = MIMEMultipart()
     msg['From'] = server_properties.MAIL_USERNAME
     msg['To'] = to_email
     msg['Subject'] = subject
     msg.attach(MIMEText(body, 'plain'))
-    print(msg.as_string())
+    return msg
+
+
+def queue_notification(subject, body, to_email):
+    """
+    Hand the notification to the background mail queue and return immediately.
+    Returns False, without failing the caller, when mail is not configured.
+    """
+    if server_properties.missing_settings('mail'):
+        log.warning("Mail is not configured; notification not sent")
+        return False
+    return mail_queue.enqueue(build_message(subject, body, to_email))
+
+
+def send_notification(subject, body, to_email):
+    msg = build_message(subject, body, to_email)
 
     try:
         server = smtplib.SMTP(server_properties.MAIL_HOST, server_properties.MAIL_PORT)
@@ -24,9 +43,9 @@ def send_notification(subject, body, to_email):
         server.login(server_properties.MAIL_USERNAME, server_properties.MAIL_PASSWORD)
         server.sendmail(server_properties.MAIL_USERNAME, to_email, msg.as_string())
         server.quit()
-        print("Notification sent successfully.")
+        log.info("Notification sent to %s", to_email)
     except Exception as e:
-        print(f"Failed to send notification: {e}")
+        log.error("Failed to send notification to %s: %s", to_email, e)
 
 # Main method for testing
 if __name__ == "__main__":
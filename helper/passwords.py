@@ -0,0 +1,99 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+import server_properties
+import logger
+from helper import metrics
+
+log = logger.get_logger(__name__)
+
+
+class PasswordPoolBusy(Exception):
+    """
+    Raised when too many hashing operations are already queued; callers should back off.
+    """
+
+
+# Password hashing functions (run inside the worker processes)
+def hash_password(password: str) -> str:
+    """
+    Hash the password using bcrypt
+    """
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
+def verify_password(stored_hash: str, password: str) -> bool:
+    """
+    Verify the password with the stored hashed password
+    """
+    return bcrypt.checkpw(password.encode('utf-8'), stored_hash.encode('utf-8'))
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt on a dedicated, size-limited process pool so hashing never blocks the event loop.
+    At most max_pending operations may be queued or running; beyond that PasswordPoolBusy is raised.
+    """
+
+    def __init__(self, max_workers, max_pending):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._pending = 0
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def _discard_broken(self, executor):
+        # Callers that hit the same broken pool only replace it once
+        if self._executor is executor:
+            self._executor = None
+            executor.shutdown(wait=False)
+            log.error("Password hashing pool broke (a worker process died); starting a new one")
+
+    async def _run(self, operation, fn, *args):
+        if self._pending >= self.max_pending:
+            raise PasswordPoolBusy()
+        self._pending += 1
+        try:
+            with metrics.timed('bcrypt', metrics.PASSWORD_HASH_SECONDS, operation):
+                loop = asyncio.get_running_loop()
+                executor = self._get_executor()
+                try:
+                    return await loop.run_in_executor(executor, fn, *args)
+                except BrokenProcessPool:
+                    # A worker was killed (e.g. out of memory); hashing is safe to repeat on a new pool
+                    self._discard_broken(executor)
+                    return await loop.run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            self._pending -= 1
+
+    async def warm_up(self):
+        """
+        Start the worker processes now, so the first signup or login does not pay for it.
+        """
+        executor = self._get_executor()
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(executor, os.getpid) for _ in range(self.max_workers)))
+
+    async def hash(self, password: str) -> str:
+        return await self._run('hash', hash_password, password)
+
+    async def verify(self, stored_hash: str, password: str) -> bool:
+        return await self._run('verify', verify_password, stored_hash, password)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+password_hasher = PasswordHasher(
+    max_workers=server_properties.PASSWORD_HASH_WORKERS,
+    max_pending=server_properties.PASSWORD_HASH_MAX_PENDING,
+)
@@ -0,0 +1,215 @@
+import asyncio
+import datetime
+import math
+import time
+
+import server_properties
+import logger
+from helper import cache, metrics
+
+log = logger.get_logger(__name__)
+
+# Google APIs with their own rate limit and daily budget
+GEOCODE = 'geocode'
+NEARBY = 'nearby'
+DETAILS = 'details'
+
+
+class UpstreamRefused(Exception):
+    """
+    A Google call was not made: rate limited (throttled) or, otherwise, out of budget or backing off.
+    retry_after is the number of seconds until a retry can succeed.
+    """
+
+    def __init__(self, api, reason, retry_after, throttled=False):
+        super().__init__(f"Google {api} API call refused: {reason}")
+        self.api = api
+        self.retry_after = retry_after
+        self.throttled = throttled
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at rate tokens per second, holding at most burst tokens.
+    Waiting callers reserve their token up front, so they are served in arrival order.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self):
+        """
+        Seconds until the next token is free.
+        """
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        return max(0.0, (1 - self._tokens) / self.rate)
+
+    async def acquire(self, max_wait):
+        """
+        Take one token, waiting up to max_wait seconds for it. Returns False when it would take longer.
+        """
+        if self.rate <= 0:
+            return True
+        wait = self.wait_time()
+        if wait > max_wait:
+            return False
+        self._tokens -= 1
+        if wait:
+            await asyncio.sleep(wait)
+        return True
+
+
+class UpstreamLimiter:
+    """
+    Rate limit and daily call budget of one Google API.
+    The API is degraded, and callers should prefer cached data of any age, while the budget is
+    within its reserve or while backing off after Google answered OVER_QUERY_LIMIT.
+    A shared budget is counted in Redis by all workers together, so it also survives worker
+    restarts; this limiter then knows the count as of its own latest call.
+    """
+
+    def __init__(self, name, rate, burst, daily_budget, reserve, max_wait, cooldown, shared=False):
+        self.name = name
+        self.daily_budget = daily_budget
+        self.shared = shared
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self.cooldown = cooldown
+        self.counters = {"calls": 0, "throttled": 0, "over_budget": 0, "over_query_limit": 0,
+                         "cooling_down": 0, "degraded_served": 0, "refreshes_skipped": 0}
+        self._bucket = TokenBucket(rate, burst)
+        self._day = None
+        self._used = 0
+        self._cooldown_until = 0.0
+
+    def _roll_day(self):
+        # Budgets are per UTC day
+        today = datetime.datetime.utcnow().date()
+        if today != self._day:
+            self._day = today
+            self._used = 0
+
+    def remaining(self):
+        """
+        Calls left in today's budget, or None when the budget is unlimited.
+        """
+        self._roll_day()
+        if not self.daily_budget:
+            return None
+        return max(self.daily_budget - self._used, 0)
+
+    def cooling_down(self):
+        return time.monotonic() < self._cooldown_until
+
+    def degraded(self):
+        remaining = self.remaining()
+        low = remaining is not None and remaining <= self.daily_budget * self.reserve
+        return low or self.cooling_down()
+
+    async def acquire(self):
+        """
+        Reserve one call: False when backing off, out of budget, or no token came within max_wait.
+        """
+        if self.cooling_down():
+            self.counters["cooling_down"] += 1
+            return False
+        if self.remaining() == 0:
+            self.counters["over_budget"] += 1
+            return False
+        if not await self._bucket.acquire(self.max_wait):
+            self.counters["throttled"] += 1
+            return False
+        self._roll_day()
+        if self.shared:
+            # Keyed by UTC day, and kept a little longer than that day
+            used = await cache.increment(f"google_budget:{self.name}:{self._day.isoformat()}", 2 * 24 * 60 * 60)
+            if used is not None:
+                # Other workers may have spent the rest of the budget since our last call
+                if self.daily_budget and used > self.daily_budget:
+                    self._used = self.daily_budget
+                    self.counters["over_budget"] += 1
+                    return False
+                self._used = used
+                self.counters["calls"] += 1
+                return True
+            # Redis cannot be reached: count on from the latest shared total this worker saw
+        self._used += 1
+        self.counters["calls"] += 1
+        return True
+
+    def refused(self):
+        """
+        The UpstreamRefused explaining why acquire() just returned False.
+        """
+        if self.cooling_down():
+            return UpstreamRefused(self.name, "backing off after OVER_QUERY_LIMIT",
+                                   self._cooldown_until - time.monotonic())
+        if self.remaining() == 0:
+            tomorrow = datetime.datetime.combine(self._day + datetime.timedelta(days=1), datetime.time())
+            return UpstreamRefused(self.name, "daily budget spent",
+                                   (tomorrow - datetime.datetime.utcnow()).total_seconds())
+        return UpstreamRefused(self.name, "rate limited", self._bucket.wait_time(), throttled=True)
+
+    def record_over_limit(self):
+        self.counters["over_query_limit"] += 1
+        self._cooldown_until = time.monotonic() + self.cooldown
+        log.warning(f"Google {self.name} API answered OVER_QUERY_LIMIT, backing off for {self.cooldown}s")
+
+    def stats(self):
+        remaining = self.remaining()
+        now = datetime.datetime.utcnow()
+        hours = max((now - datetime.datetime.combine(self._day, datetime.time())).total_seconds() / 3600, 1 / 60)
+        burn_per_hour = self._used / hours
+        return {
+            "daily_budget": self.daily_budget or None,
+            "used_today": self._used,
+            "remaining": remaining,
+            "burn_per_hour": round(burn_per_hour, 2),
+            "projected_today": round(burn_per_hour * 24),
+            "degraded": self.degraded(),
+            **self.counters,
+        }
+
+
+def _limiter(name, rate, burst, daily_budget):
+    # Rate limits are kept per process, so each of the WEB_CONCURRENCY workers gets its share of the
+    # totals. So do daily budgets, unless CACHE_BACKEND=redis: a per-process share starts over when
+    # its worker is restarted (e.g. recycled after MAX_REQUESTS), while a shared one lives in Redis.
+    workers = server_properties.WEB_CONCURRENCY
+    shared = server_properties.CACHE_BACKEND == 'redis'
+    if not shared:
+        daily_budget = math.ceil(daily_budget / workers)
+    return UpstreamLimiter(
+        name, rate / workers, max(burst // workers, 1), daily_budget,
+        reserve=server_properties.GOOGLE_BUDGET_RESERVE,
+        max_wait=server_properties.GOOGLE_RATE_LIMIT_MAX_WAIT,
+        cooldown=server_properties.GOOGLE_OVER_LIMIT_COOLDOWN,
+        shared=shared,
+    )
+
+
+limiters = {
+    GEOCODE: _limiter(GEOCODE, server_properties.GOOGLE_GEOCODE_QPS, server_properties.GOOGLE_GEOCODE_BURST,
+                      server_properties.GOOGLE_GEOCODE_DAILY_BUDGET),
+    NEARBY: _limiter(NEARBY, server_properties.GOOGLE_NEARBY_QPS, server_properties.GOOGLE_NEARBY_BURST,
+                     server_properties.GOOGLE_NEARBY_DAILY_BUDGET),
+    DETAILS: _limiter(DETAILS, server_properties.GOOGLE_DETAILS_QPS, server_properties.GOOGLE_DETAILS_BURST,
+                      server_properties.GOOGLE_DETAILS_DAILY_BUDGET),
+}
+
+
+def stats():
+    return {name: limiter.stats() for name, limiter in limiters.items()}
+
+
+metrics.register_quota_stats(stats)
@@ -0,0 +1,27 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Collapse concurrent calls that share a key into a single in-flight execution.
+    Every caller awaiting the same key receives the same result (or exception).
+    """
+
+    def __init__(self):
+        self._inflight = {}
+
+    def in_flight(self, key):
+        return key in self._inflight
+
+    async def do(self, key, fn, *args, **kwargs):
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn(*args, **kwargs))
+            self._inflight[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+        # Shield the shared call so one cancelled caller does not cancel it for the others
+        return await asyncio.shield(future)
+
+    def _forget(self, key, future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
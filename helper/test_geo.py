@@ -0,0 +1,99 @@
+import math
+import random
+
+import pytest
+
+from helper import geo
+
+MAX_SEARCH_RADIUS = 50000
+MAX_TILES = 16
+
+PLACES = {
+    "new_york": (40.7128, -74.0060),
+    "equator": (0.1, 10.0),
+    "oslo": (59.9139, 10.7522),
+}
+
+
+def tiles_for(place, radius):
+    latitude, longitude = PLACES[place]
+    return geo.geohash_tiles(latitude, longitude, radius, MAX_TILES, min(radius, MAX_SEARCH_RADIUS))
+
+
+def points_in_circle(latitude, longitude, radius, count=500):
+    rng = random.Random(42)
+    for _ in range(count):
+        distance = radius * math.sqrt(rng.random())
+        bearing = rng.uniform(0, 2 * math.pi)
+        d_lat = math.degrees(distance * math.cos(bearing) / geo.EARTH_RADIUS_M)
+        d_lng = math.degrees(distance * math.sin(bearing) / (geo.EARTH_RADIUS_M * math.cos(math.radians(latitude))))
+        yield latitude + d_lat, longitude + d_lng
+
+
+@pytest.mark.parametrize("place", PLACES)
+@pytest.mark.parametrize("radius", [2000, 5000, 8000, 15000, 30000, 40000, 50000, 100000])
+def test_tiles_are_never_wider_than_the_search(place, radius):
+    for tile in tiles_for(place, radius):
+        assert tile.radius <= min(radius, MAX_SEARCH_RADIUS)
+
+
+@pytest.mark.parametrize("place", PLACES)
+@pytest.mark.parametrize("radius", [2000, 5000, 8000, 15000, 30000, 40000, 50000, 100000])
+def test_tile_count_stays_within_the_limit(place, radius):
+    assert len(tiles_for(place, radius)) <= MAX_TILES
+
+
+@pytest.mark.parametrize("place, radius", [
+    ("new_york", 5000), ("new_york", 30000), ("new_york", 40000),
+    ("equator", 5000), ("equator", 30000), ("equator", 50000),
+    ("oslo", 5000), ("oslo", 30000),
+])
+def test_tiles_cover_the_whole_search_circle(place, radius):
+    latitude, longitude = PLACES[place]
+    tiles = tiles_for(place, radius)
+    assert tiles
+    for lat, lng in points_in_circle(latitude, longitude, radius):
+        assert any(geo.haversine_m(tile.latitude, tile.longitude, lat, lng) <= tile.radius for tile in tiles)
+
+
+def test_tiles_are_distinct_cells_touching_the_circle():
+    latitude, longitude = PLACES["new_york"]
+    tiles = tiles_for("new_york", 30000)
+    assert len({tile.geohash for tile in tiles}) == len(tiles)
+    for tile in tiles:
+        assert geo.haversine_m(latitude, longitude, tile.latitude, tile.longitude) <= 30000 + tile.radius
+
+
+def test_finest_fitting_precision_is_used():
+    tiles = tiles_for("new_york", 5000)
+    precision = len(tiles[0].geohash)
+    assert all(len(tile.geohash) == precision for tile in tiles)
+    latitude, longitude = PLACES["new_york"]
+    assert len(geo.geohash_tiles(latitude, longitude, 5000, 10 ** 6, 5000)) > MAX_TILES
+
+
+@pytest.mark.parametrize("place, radius", [
+    ("new_york", 2500), ("new_york", 8000), ("new_york", 50000),
+    ("equator", 12000), ("oslo", 2000), ("oslo", 100000),
+])
+def test_capped_searches_fetch_the_cells_nearest_the_centre(place, radius):
+    # Every fitting precision needs more than MAX_TILES cells here
+    latitude, longitude = PLACES[place]
+    tiles = tiles_for(place, radius)
+    assert len(tiles) == MAX_TILES
+    assert any(geo.haversine_m(tile.latitude, tile.longitude, latitude, longitude) <= tile.radius for tile in tiles)
+    precision = len(tiles[0].geohash)
+    farthest = max(geo.haversine_m(latitude, longitude, tile.latitude, tile.longitude) for tile in tiles)
+    chosen = {tile.geohash for tile in tiles}
+    cells = geo._cover_cells(latitude, longitude, radius, precision, geo._circle_bbox(latitude, longitude, radius))
+    for cell in cells:
+        if cell.geohash not in chosen:
+            assert geo.haversine_m(latitude, longitude, cell.latitude, cell.longitude) >= farthest
+
+
+def test_geohash_round_trip():
+    latitude, longitude = PLACES["oslo"]
+    geohash = geo.geohash_encode(latitude, longitude, 7)
+    min_lat, min_lng, max_lat, max_lng = geo.geohash_bbox(geohash)
+    assert min_lat <= latitude <= max_lat
+    assert min_lng <= longitude <= max_lng
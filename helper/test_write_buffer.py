@@ -0,0 +1,190 @@
+import asyncio
+
+import pytest
+from elasticsearch import ConnectionError as ESConnectionError
+
+from helper import es_repository
+from helper.write_buffer import WriteBehindBuffer
+
+FLUSH_INTERVAL = 0.01
+MAX_ATTEMPTS = 3
+
+
+class FakeBulk:
+    """
+    Stands in for es_repository.bulk_results: each call pops the next outcome, an exception to
+    raise or a function giving the (ok, item) result of an action.
+    """
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    async def __call__(self, actions, **kwargs):
+        self.calls.append([action['_id'] for action in actions])
+        outcome = self.outcomes.pop(0) if self.outcomes else written
+        if isinstance(outcome, Exception):
+            raise outcome
+        return [outcome(action) for action in actions]
+
+
+def written(action):
+    return True, {action.get('_op_type', 'index'): {'_index': action['_index'], '_id': action['_id'], 'status': 200}}
+
+
+def rejected(status, ids=None):
+    def result(action):
+        if ids is not None and action['_id'] not in ids:
+            return written(action)
+        return False, {action.get('_op_type', 'index'): {
+            '_index': action['_index'], '_id': action['_id'], 'status': status, 'error': f"status {status}"}}
+    return result
+
+
+def action(id, op_type='index'):
+    return {'_op_type': op_type, '_index': 'docs', '_id': id, '_source': {'id': id}}
+
+
+@pytest.fixture
+def bulk(monkeypatch):
+    def install(*outcomes):
+        fake = FakeBulk(*outcomes)
+        monkeypatch.setattr(es_repository, 'bulk_results', fake)
+        return fake
+    return install
+
+
+def new_buffer():
+    return WriteBehindBuffer(max_batch=10, flush_interval=FLUSH_INTERVAL, max_pending=100, max_attempts=MAX_ATTEMPTS)
+
+
+async def add_all(buffer, *ids):
+    for id in ids:
+        await buffer.add(action(id))
+
+
+def test_transport_error_requeues_the_batch_and_keeps_it_readable(bulk):
+    fake = bulk(ESConnectionError("refused"))
+
+    async def scenario():
+        buffer = new_buffer()
+        await add_all(buffer, 'a', 'b')
+        await buffer.flush()
+        assert buffer.pending == 2
+        assert buffer.pending_source('docs', 'a') == {'id': 'a'}
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await buffer.flush()
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert fake.calls == [['a', 'b'], ['a', 'b']]
+    assert (buffer.written, buffer.failed, buffer.pending) == (2, 0, 0)
+    assert buffer.pending_source('docs', 'a') is None
+
+
+def test_actions_are_dropped_after_max_attempts(bulk):
+    fake = bulk(*[ESConnectionError("refused")] * MAX_ATTEMPTS)
+
+    async def scenario():
+        buffer = new_buffer()
+        await add_all(buffer, 'a')
+        for _ in range(MAX_ATTEMPTS):
+            await buffer.flush()
+            await asyncio.sleep(FLUSH_INTERVAL)
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert len(fake.calls) == MAX_ATTEMPTS
+    assert (buffer.written, buffer.failed, buffer.pending) == (0, 1, 0)
+    assert buffer.pending_source('docs', 'a') is None
+    assert buffer._attempts == {}
+
+
+def test_no_retry_before_the_flush_interval(bulk):
+    fake = bulk(ESConnectionError("refused"))
+
+    async def scenario():
+        buffer = WriteBehindBuffer(max_batch=10, flush_interval=60, max_pending=100, max_attempts=MAX_ATTEMPTS)
+        await add_all(buffer, 'a')
+        await buffer.flush()
+        await buffer.flush()
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert len(fake.calls) == 1
+    assert buffer.pending == 1
+
+
+@pytest.mark.parametrize("status", [429, 503])
+def test_rejected_actions_are_retried_and_the_rest_written(bulk, status):
+    fake = bulk(rejected(status, ids={'b'}))
+
+    async def scenario():
+        buffer = new_buffer()
+        await add_all(buffer, 'a', 'b', 'c')
+        await buffer.flush()
+        assert buffer.pending == 1
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await buffer.flush()
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert fake.calls == [['a', 'b', 'c'], ['b']]
+    assert (buffer.written, buffer.failed, buffer.pending) == (3, 0, 0)
+
+
+def test_other_errors_are_dropped_without_retry(bulk):
+    fake = bulk(rejected(400, ids={'b'}))
+
+    async def scenario():
+        buffer = new_buffer()
+        await add_all(buffer, 'a', 'b')
+        await buffer.add(action('c', op_type='create'))
+        await buffer.flush()
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert len(fake.calls) == 1
+    assert (buffer.written, buffer.failed, buffer.pending) == (2, 1, 0)
+
+
+def test_existing_document_on_create_is_not_a_failure(bulk):
+    bulk(rejected(409))
+
+    async def scenario():
+        buffer = new_buffer()
+        await buffer.add(action('a', op_type='create'))
+        await buffer.flush()
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert (buffer.written, buffer.failed, buffer.pending) == (0, 0, 0)
+
+
+def test_requeued_actions_go_before_newer_ones(bulk):
+    fake = bulk(ESConnectionError("refused"))
+
+    async def scenario():
+        buffer = new_buffer()
+        await add_all(buffer, 'a')
+        await buffer.flush()
+        await add_all(buffer, 'b')
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await buffer.flush()
+
+    asyncio.run(scenario())
+    assert fake.calls == [['a'], ['a', 'b']]
+
+
+def test_stop_gives_requeued_actions_their_remaining_attempts(bulk):
+    fake = bulk(ESConnectionError("refused"), rejected(429))
+
+    async def scenario():
+        buffer = new_buffer()
+        await add_all(buffer, 'a')
+        await buffer.stop()
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert len(fake.calls) == MAX_ATTEMPTS
+    assert (buffer.written, buffer.failed, buffer.pending) == (1, 0, 0)
@@ -1,10 +1,10 @@
 import server_properties
 
 import logger
-log = logger.get_logger()
+log = logger.get_logger(__name__)
 
 url = server_properties.GOOGLE_PLACES_API_BASE_URL
-api_key = server_properties.GOOGLE_API_KEY
 
+# The API key is added by the caller when the request is sent
 def build_places_url(location, radius=5000, keyword='restaurant'):
-    return f"{url}?location={location}&radius={radius}&keyword={keyword}&key={api_key}"
+    return f"{url}?location={location}&radius={radius}&keyword={keyword}"
@@ -0,0 +1,177 @@
+import asyncio
+
+from elasticsearch import TransportError
+
+import server_properties
+import logger
+from helper import es_repository, background
+
+log = logger.get_logger(__name__)
+
+# Statuses of a rejected or unavailable cluster, whole request or per action: worth retrying
+RETRYABLE_STATUSES = (429, 502, 503, 504)
+
+
+class WriteBehindBuffer:
+    """
+    Collects Elasticsearch bulk actions off the request path and writes them in batches,
+    flushing when max_batch actions are waiting or every flush_interval seconds.
+    Documents waiting to be written can still be read back with pending_source().
+    Actions that cannot reach Elasticsearch or are rejected by it (RETRYABLE_STATUSES) are
+    re-queued, up to max_attempts tries each.
+    """
+
+    def __init__(self, max_batch, flush_interval, max_pending, max_attempts):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.written = 0
+        self.failed = 0
+        self._actions = []
+        self._pending_docs = {}
+        # Failed tries so far of the re-queued actions, by id() of the action
+        self._attempts = {}
+        # Loop time before which a batch that failed to reach Elasticsearch is not tried again
+        self._retry_at = 0.0
+        # Created on first flush: on Python < 3.10 a lock binds to the loop current when it is made,
+        # and the buffer is built at import time, before the server's loop exists
+        self._flush_lock = None
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.ensure_future(self._run())
+        log.info("Started write-behind buffer")
+
+    async def add(self, action):
+        """
+        Queue one bulk action. Waits for a flush only when the buffer is full (backpressure).
+        """
+        self._actions.append(action)
+        if action.get('_op_type', 'index') in ('index', 'create'):
+            self._pending_docs[(action['_index'], action.get('_id'))] = action
+        if len(self._actions) >= self.max_pending:
+            delay = self._retry_at - asyncio.get_running_loop().time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.flush()
+        elif len(self._actions) >= self.max_batch:
+            background.spawn(self.flush())
+
+    @property
+    def pending(self):
+        return len(self._actions)
+
+    def pending_source(self, index, id):
+        """
+        Return the _source of a document still waiting to be written, or None.
+        """
+        action = self._pending_docs.get((index, id))
+        return action['_source'] if action is not None else None
+
+    async def flush(self):
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            while self._actions and asyncio.get_running_loop().time() >= self._retry_at:
+                batch = self._actions[:self.max_batch]
+                del self._actions[:self.max_batch]
+                if not await self._write(batch):
+                    # Elasticsearch is unreachable or overloaded: the rest waits for the next flush interval
+                    self._retry_at = asyncio.get_running_loop().time() + self.flush_interval
+
+    def _forget(self, actions):
+        for action in actions:
+            self._attempts.pop(id(action), None)
+            key = (action['_index'], action.get('_id'))
+            if self._pending_docs.get(key) is action:
+                del self._pending_docs[key]
+
+    def _requeue(self, actions, reason):
+        retry, dropped = [], []
+        for action in actions:
+            attempts = self._attempts.get(id(action), 0) + 1
+            if attempts < self.max_attempts:
+                self._attempts[id(action)] = attempts
+                retry.append(action)
+            else:
+                dropped.append(action)
+        # Back in front of the queue, ahead of anything added since, and still readable meanwhile
+        self._actions[:0] = retry
+        self._forget(dropped)
+        self.failed += len(dropped)
+        log.error(f"Write-behind {reason}; {len(retry)} re-queued, "
+                  f"{len(dropped)} dropped after {self.max_attempts} attempts")
+
+    async def _write(self, batch):
+        """
+        Write one batch, returning False when some of it was re-queued because Elasticsearch
+        could not be reached or rejected it.
+        """
+        try:
+            results = await es_repository.bulk_results(batch, raise_on_error=False, raise_on_exception=False)
+        except TransportError as e:
+            self._requeue(batch, f"bulk of {len(batch)} actions failed: {e!r}")
+            return False
+        except Exception as e:
+            self._forget(batch)
+            self.failed += len(batch)
+            log.error(f"Write-behind bulk of {len(batch)} actions failed: {e!r}")
+            return True
+
+        # An error on the whole request comes back as the same error for every action
+        retry, statuses = [], set()
+        for action, (ok, item) in zip(batch, results):
+            if ok:
+                self.written += 1
+                continue
+            op_type, result = next(iter(item.items()))
+            status = result.get('status')
+            if status in RETRYABLE_STATUSES:
+                retry.append(action)
+                statuses.add(status)
+                continue
+            # A create that hits an existing document is the idempotent no-op we asked for
+            if op_type == 'create' and status == 409:
+                continue
+            self.failed += 1
+            log.error(f"Write-behind {op_type} failed for {result.get('_index')}/{result.get('_id')}: "
+                      f"{result.get('error')}")
+        retried = set(map(id, retry))
+        self._forget([action for action in batch if id(action) not in retried])
+        if retry:
+            self._requeue(retry, f"bulk of {len(batch)} actions: {len(retry)} rejected with status "
+                                 f"{', '.join(map(str, sorted(statuses)))}")
+            return False
+        return True
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                log.error(f"Write-behind flush failed: {e!r}")
+
+    async def stop(self):
+        """
+        Stop the periodic flush and write out everything still buffered.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        # Re-queued batches get their remaining attempts, one per flush interval
+        while self._actions:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+        log.info(f"Drained write-behind buffer ({self.written} written, {self.failed} failed)")
+
+
+write_buffer = WriteBehindBuffer(
+    max_batch=server_properties.WRITE_BUFFER_MAX_BATCH,
+    flush_interval=server_properties.WRITE_BUFFER_FLUSH_INTERVAL,
+    max_pending=server_properties.WRITE_BUFFER_MAX_PENDING,
+    max_attempts=server_properties.WRITE_BUFFER_MAX_ATTEMPTS,
+)
@@ -1,37 +1,219 @@
+import atexit
+import contextvars
+import datetime
+import json
 import logging.config
+import logging.handlers
+import queue
+import random
+import re
 import sys
+import uuid
+
+import server_properties
+
+# Id of the request being handled, attached to every record logged while handling it
+# (and by the background tasks it starts, which inherit the context)
+request_id_var = contextvars.ContextVar('request_id', default=None)
+
+# Incoming X-Request-ID values are only reused when they look like an id
+_REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._:-]{1,128}$')
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only a share of the records below WARNING from the loggers given in rates (and their
+    children); warnings and errors always pass. Dropped records are never formatted.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self._resolved = {}
+
+    def _rate(self, name):
+        rate = self._resolved.get(name)
+        if rate is None:
+            rate, prefix = 1.0, name
+            while prefix:
+                if prefix in self.rates:
+                    rate = self.rates[prefix]
+                    break
+                prefix = prefix.rpartition('.')[0]
+            self._resolved[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, for log shippers.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc)
+                    .isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+            'process': record.process,
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the listener thread, which formats and writes them. When the queue is
+    full the record is dropped rather than making the caller wait on the output.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Only the %-interpolation happens here, while the arguments still hold their current
+        # values; JSON encoding and traceback formatting are left to the listener thread
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def parse_sample_rates(value):
+    """
+    Parse 'logger=rate,logger=rate' into a dict of rates between 0 and 1.
+    """
+    rates = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        name, _, rate = item.partition('=')
+        rates[name.strip()] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+
 log_config = {
     'version': 1,
     'disable_existing_loggers': False,
     'formatters': {
         'simple': {
-            'format': '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+            'format': '%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
+        },
+        'json': {
+            '()': JsonFormatter,
         },
     },
     'handlers': {
         'console': {
             'class': 'logging.StreamHandler',
             'level': 'DEBUG',
-            'formatter': 'simple',
+            'formatter': 'json' if server_properties.LOG_FORMAT == 'json' else 'simple',
             'stream': 'ext://sys.stdout'
         },
     },
     'loggers': {
         '': {
             'handlers': ['console'],
-            'level': 'INFO',
+            'level': server_properties.LOG_LEVEL,
             'propagate': True
-        }
+        },
+        # One line per Elasticsearch request and per Google call; failures are still logged
+        'elastic_transport': {
+            'level': 'WARNING',
+        },
+        'httpx': {
+            'level': 'WARNING',
+        },
     }
 }
 
 logging.config.dictConfig(log_config)
 
+# Move the configured handlers behind a queue: request handlers only enqueue records, and a
+# listener thread formats and writes them
+_root = logging.getLogger()
+queue_handler = NonBlockingQueueHandler(queue.Queue(server_properties.LOG_QUEUE_SIZE))
+queue_handler.addFilter(SamplingFilter(parse_sample_rates(server_properties.LOG_SAMPLE_RATES)))
+queue_handler.addFilter(RequestIdFilter())
+_listener = logging.handlers.QueueListener(queue_handler.queue, *_root.handlers, respect_handler_level=True)
+_root.handlers = [queue_handler]
+_listener.start()
+
+
+def _stop_listener():
+    # Write out what is still queued when the process exits
+    _listener.stop()
+    if queue_handler.dropped:
+        sys.stderr.write(f"Dropped {queue_handler.dropped} log records while the log queue was full\n")
+
+
+atexit.register(_stop_listener)
+
 # Handling case where __file__ is not set
 if hasattr(sys.modules['__main__'], '__file__'):
     name = str(sys.modules['__main__'].__file__).split("/")[-1].split('.')[0]
 else:
     name = '__main__'  # Fallback when __file__ is not available
 
-def get_logger():
-    return logging.getLogger(name)
+def get_logger(logger_name=None):
+    """
+    Return the logger for logger_name (pass __name__, so LOG_SAMPLE_RATES can target the module),
+    or the logger named after the main script.
+    """
+    return logging.getLogger(logger_name or name)
+
+
+class RequestIdMiddleware:
+    """
+    ASGI middleware giving every request an id, the caller's X-Request-ID or a new one. The id is
+    attached to the records logged while handling the request and returned in X-Request-ID.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        request_id = None
+        for header, value in scope['headers']:
+            if header == b'x-request-id':
+                request_id = value.decode('latin-1')
+                break
+        if request_id is None or not _REQUEST_ID_PATTERN.match(request_id):
+            request_id = uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+
+        async def send_with_request_id(message):
+            if message['type'] == 'http.response.start':
+                headers = list(message.get('headers', []))
+                headers.append((b'x-request-id', request_id.encode('latin-1')))
+                message = {**message, 'headers': headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id_var.reset(token)
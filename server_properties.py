@@ -3,26 +3,169 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+class MissingSettingError(Exception):
+    """
+    Raised when a required environment variable is read but not set.
+    """
+
 def get_env_variable(var_name):
     try:
         return os.environ[var_name]
     except KeyError:
         error_msg = "Set the %s environment variable" % var_name
-        raise Exception(error_msg)
+        raise MissingSettingError(error_msg)
+
+def get_env_int(var_name, default):
+    return int(os.environ.get(var_name, default))
+
+def get_env_float(var_name, default):
+    return float(os.environ.get(var_name, default))
+
+def get_env_bool(var_name, default):
+    return os.environ.get(var_name, str(default)).lower() in ('1', 'true', 'yes')
+
+
+# Credentials without a default are read when first used rather than at import,
+# so a subsystem with missing settings fails on its own instead of stopping the app
+REQUIRED_SETTINGS = {
+    'GOOGLE_API_KEY': 'GOOGLE_API_KEY',
+    'ES_HOST': 'ES_HOST',
+    'ES_USER': 'ES_USERNAME',
+    'ES_PASSWORD': 'ES_PASSWORD',
+    'SECRET_KEY': 'SECRET_KEY',
+    'ALGORITHM': 'ALGORITHM',
+    'MAIL_USERNAME': 'MAIL_USERNAME',
+    'MAIL_PASSWORD': 'MAIL_PASSWORD',
+}
+# Environment variables each subsystem needs
+SUBSYSTEM_SETTINGS = {
+    'google': ['GOOGLE_API_KEY'],
+    'elasticsearch': ['ES_HOST', 'ES_USERNAME', 'ES_PASSWORD'],
+    'auth': ['SECRET_KEY', 'ALGORITHM'],
+    'mail': ['MAIL_USERNAME', 'MAIL_PASSWORD'],
+}
+
+def __getattr__(name):
+    if name in REQUIRED_SETTINGS:
+        return get_env_variable(REQUIRED_SETTINGS[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def missing_settings(subsystem):
+    """
+    Return the environment variables the subsystem needs that are not set.
+    """
+    return [var_name for var_name in SUBSYSTEM_SETTINGS[subsystem] if not os.environ.get(var_name)]
 
 
-GOOGLE_API_KEY = get_env_variable('GOOGLE_API_KEY')
-GOOGLE_PLACES_API_BASE_URL = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
-GOOGLE_GEOCODE_API_BASE_URL = 'https://maps.googleapis.com/maps/api/geocode/json'
-ES_HOST = get_env_variable('ES_HOST')
-ES_USER = get_env_variable('ES_USERNAME')
-ES_PASSWORD = get_env_variable('ES_PASSWORD')
-SECRET_KEY = get_env_variable('SECRET_KEY')
-ALGORITHM = get_env_variable('ALGORITHM')
+# Logging: level, 'json' or 'text' lines, and the share of INFO/DEBUG records kept per logger as
+# 'logger=rate,...' (warnings and errors are always kept); records are written by a background thread
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json').lower()
+LOG_SAMPLE_RATES = os.environ.get('LOG_SAMPLE_RATES', 'controller.maps_controller=0.1,service.maps_service=0.1')
+LOG_QUEUE_SIZE = get_env_int('LOG_QUEUE_SIZE', 10000)  # records waiting to be written; more are dropped
+# Worker processes serving the app (gunicorn.conf.py and uvicorn --workers both read WEB_CONCURRENCY);
+# per-process limits such as the Google budgets and the bcrypt pool are split between them
+WEB_CONCURRENCY = max(get_env_int('WEB_CONCURRENCY', 1), 1)
+# With several workers, how often each one writes its cache and Google budget stats for /metrics (seconds)
+METRICS_PUBLISH_INTERVAL = get_env_float('METRICS_PUBLISH_INTERVAL', 5.0)
+# Where the geocode and user caches live: 'memory' (per process) or 'redis' (shared by all workers)
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory').lower()
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+REDIS_KEY_PREFIX = os.environ.get('REDIS_KEY_PREFIX', 'location-search:')
+REDIS_TIMEOUT = get_env_float('REDIS_TIMEOUT', 0.5)  # seconds; a slow cache is treated as a miss
+REDIS_MAX_CONNECTIONS = get_env_int('REDIS_MAX_CONNECTIONS', 50)
+# How long the shared cache is bypassed after Redis could not be reached (seconds)
+REDIS_RETRY_INTERVAL = get_env_float('REDIS_RETRY_INTERVAL', 5.0)
+# Google endpoints can be pointed elsewhere, e.g. at the local stand-ins used by the benchmark
+GOOGLE_PLACES_API_BASE_URL = os.environ.get('GOOGLE_PLACES_API_BASE_URL', "https://maps.googleapis.com/maps/api/place/nearbysearch/json")
+GOOGLE_GEOCODE_API_BASE_URL = os.environ.get('GOOGLE_GEOCODE_API_BASE_URL', 'https://maps.googleapis.com/maps/api/geocode/json')
+GOOGLE_PLACE_DETAILS_API_BASE_URL = os.environ.get('GOOGLE_PLACE_DETAILS_API_BASE_URL', "https://maps.googleapis.com/maps/api/place/details/json")
+# Outbound HTTP client configuration (shared pool for all Google calls)
+HTTP_MAX_CONNECTIONS = get_env_int('HTTP_MAX_CONNECTIONS', 200)
+HTTP_MAX_KEEPALIVE_CONNECTIONS = get_env_int('HTTP_MAX_KEEPALIVE_CONNECTIONS', 50)
+HTTP_KEEPALIVE_EXPIRY = get_env_float('HTTP_KEEPALIVE_EXPIRY', 30.0)
+HTTP_MAX_CONCURRENCY_PER_HOST = get_env_int('HTTP_MAX_CONCURRENCY_PER_HOST', 100)
+HTTP_TIMEOUT = get_env_float('HTTP_TIMEOUT', 10.0)
+HTTP_CONNECT_TIMEOUT = get_env_float('HTTP_CONNECT_TIMEOUT', 3.0)
+HTTP_VERIFY_SSL = get_env_bool('HTTP_VERIFY_SSL', True)
+# Geocoding cache configuration (CACHE_BACKEND cache backed by the geocode_cache index)
+GEOCODE_CACHE_MAX_ENTRIES = get_env_int('GEOCODE_CACHE_MAX_ENTRIES', 10000)
+GEOCODE_CACHE_TTL = get_env_int('GEOCODE_CACHE_TTL', 24 * 60 * 60)  # seconds
+GEOCODE_ES_CACHE_TTL = get_env_int('GEOCODE_ES_CACHE_TTL', 30 * 24 * 60 * 60)  # seconds
+# Nearby search cache configuration
+MAX_SEARCH_RADIUS = 50000  # Largest radius accepted by Places Nearby Search, in metres
+PLACES_PAGE_SIZE = 20  # Most results Places Nearby Search returns for one call
+COVERAGE_CANDIDATES = get_env_int('COVERAGE_CANDIDATES', 50)
+# Fewest cached places a search reads; wide ones read up to PLACES_PAGE_SIZE per tile
+NEARBY_CACHE_MAX_RESULTS = get_env_int('NEARBY_CACHE_MAX_RESULTS', 100)
+# Cached areas are served as-is until NEARBY_FRESH_TTL, then served stale while they are
+# refreshed in the background, and dropped after NEARBY_CACHE_TTL (seconds)
+NEARBY_FRESH_TTL = get_env_int('NEARBY_FRESH_TTL', 24 * 60 * 60)
+NEARBY_CACHE_TTL = get_env_int('NEARBY_CACHE_TTL', 30 * 24 * 60 * 60)
+# Searches wider than this are split into geohash tiles, fetched per tile
+TILE_MIN_RADIUS = get_env_int('TILE_MIN_RADIUS', 1500)
+MAX_TILES_PER_SEARCH = get_env_int('MAX_TILES_PER_SEARCH', 16)
+# Ranking of nearby results: signal weights, Google rating assumed when missing,
+# number of our own reviews before they outweigh the Google rating, and results kept (0 = all)
+RANK_WEIGHT_DISTANCE = get_env_float('RANK_WEIGHT_DISTANCE', 0.35)
+RANK_WEIGHT_RATING = get_env_float('RANK_WEIGHT_RATING', 0.35)
+RANK_WEIGHT_POPULARITY = get_env_float('RANK_WEIGHT_POPULARITY', 0.15)
+RANK_WEIGHT_REVIEWS = get_env_float('RANK_WEIGHT_REVIEWS', 0.15)
+RANK_RATING_PRIOR = get_env_float('RANK_RATING_PRIOR', 3.0)
+RANK_REVIEWS_PRIOR_COUNT = get_env_float('RANK_REVIEWS_PRIOR_COUNT', 5.0)
+RANK_TOP_K = get_env_int('RANK_TOP_K', 60)
+# Restaurant details cache configuration
+DETAILS_FRESH_TTL = get_env_int('DETAILS_FRESH_TTL', 24 * 60 * 60)  # seconds
+DETAILS_CACHE_TTL = get_env_int('DETAILS_CACHE_TTL', 30 * 24 * 60 * 60)  # seconds
+MAX_DETAILS_BATCH_SIZE = get_env_int('MAX_DETAILS_BATCH_SIZE', 50)
+# Google API rate limits (requests per second and burst, per API) and daily call budgets (0 = unlimited).
+# One cold wide search makes up to MAX_TILES_PER_SEARCH Nearby calls at once and one details batch
+# up to MAX_DETAILS_BATCH_SIZE Details calls, so the bursts leave room for several of them
+GOOGLE_GEOCODE_QPS = get_env_float('GOOGLE_GEOCODE_QPS', 20.0)
+GOOGLE_GEOCODE_BURST = get_env_int('GOOGLE_GEOCODE_BURST', 40)
+GOOGLE_GEOCODE_DAILY_BUDGET = get_env_int('GOOGLE_GEOCODE_DAILY_BUDGET', 10000)
+GOOGLE_NEARBY_QPS = get_env_float('GOOGLE_NEARBY_QPS', 50.0)
+GOOGLE_NEARBY_BURST = get_env_int('GOOGLE_NEARBY_BURST', 10 * MAX_TILES_PER_SEARCH)
+GOOGLE_NEARBY_DAILY_BUDGET = get_env_int('GOOGLE_NEARBY_DAILY_BUDGET', 5000)
+GOOGLE_DETAILS_QPS = get_env_float('GOOGLE_DETAILS_QPS', 25.0)
+GOOGLE_DETAILS_BURST = get_env_int('GOOGLE_DETAILS_BURST', 2 * MAX_DETAILS_BATCH_SIZE)
+GOOGLE_DETAILS_DAILY_BUDGET = get_env_int('GOOGLE_DETAILS_DAILY_BUDGET', 5000)
+# Longest a request waits for a rate-limit token before it is refused (seconds)
+GOOGLE_RATE_LIMIT_MAX_WAIT = get_env_float('GOOGLE_RATE_LIMIT_MAX_WAIT', 2.0)
+# Share of the daily budget held back: below it, cached data of any age is served instead of calling out
+GOOGLE_BUDGET_RESERVE = get_env_float('GOOGLE_BUDGET_RESERVE', 0.1)
+# How long an API is left alone after Google answers OVER_QUERY_LIMIT (seconds)
+GOOGLE_OVER_LIMIT_COOLDOWN = get_env_float('GOOGLE_OVER_LIMIT_COOLDOWN', 30.0)
+ES_CONNECTIONS_PER_NODE = get_env_int('ES_CONNECTIONS_PER_NODE', 25)
+ES_REQUEST_TIMEOUT = get_env_float('ES_REQUEST_TIMEOUT', 10.0)
+ES_MAX_RETRIES = get_env_int('ES_MAX_RETRIES', 3)
+# Password hashing pool: bcrypt runs in worker processes, with a cap on queued operations
+PASSWORD_HASH_WORKERS = get_env_int('PASSWORD_HASH_WORKERS', max((os.cpu_count() or 1) // WEB_CONCURRENCY, 1))
+PASSWORD_HASH_MAX_PENDING = get_env_int('PASSWORD_HASH_MAX_PENDING', 64)
+# Write-behind buffer for cache, favorite and review writes
+WRITE_BUFFER_MAX_BATCH = get_env_int('WRITE_BUFFER_MAX_BATCH', 500)
+WRITE_BUFFER_FLUSH_INTERVAL = get_env_float('WRITE_BUFFER_FLUSH_INTERVAL', 1.0)  # seconds
+WRITE_BUFFER_MAX_PENDING = get_env_int('WRITE_BUFFER_MAX_PENDING', 10000)
+# Tries per buffered write while Elasticsearch cannot be reached, one per flush
+WRITE_BUFFER_MAX_ATTEMPTS = get_env_int('WRITE_BUFFER_MAX_ATTEMPTS', 3)
+# Largest page size accepted by the favorites and reviews listings
+MAX_PAGE_SIZE = get_env_int('MAX_PAGE_SIZE', 100)
+# Short-TTL cache (CACHE_BACKEND) in front of user lookups
+USER_CACHE_MAX_ENTRIES = get_env_int('USER_CACHE_MAX_ENTRIES', 10000)
+USER_CACHE_TTL = get_env_int('USER_CACHE_TTL', 30)  # seconds
+# Verified-token cache used by the JWT dependency
+TOKEN_CACHE_MAX_ENTRIES = get_env_int('TOKEN_CACHE_MAX_ENTRIES', 50000)
+TOKEN_CACHE_MAX_TTL = get_env_int('TOKEN_CACHE_MAX_TTL', 30 * 60)  # seconds
 # Email configuration
-MAIL_HOST = 'smtp.gmail.com'
-MAIL_PORT = 587
-MAIL_USERNAME = get_env_variable('MAIL_USERNAME')  # Replace with your method of securely getting the email
-MAIL_PASSWORD = get_env_variable('MAIL_PASSWORD')  # Replace with your method of securely getting the password
-MAIL_USE_TLS = True
-MAIL_USE_AUTH = True
+MAIL_HOST = os.environ.get('MAIL_HOST', 'smtp.gmail.com')
+MAIL_PORT = get_env_int('MAIL_PORT', 587)
+MAIL_USE_TLS = get_env_bool('MAIL_USE_TLS', True)
+MAIL_USE_AUTH = get_env_bool('MAIL_USE_AUTH', True)
+MAIL_TIMEOUT = get_env_float('MAIL_TIMEOUT', 10.0)
+# Background mail queue configuration
+MAIL_WORKERS = get_env_int('MAIL_WORKERS', 2)
+MAIL_BATCH_SIZE = get_env_int('MAIL_BATCH_SIZE', 20)
+MAIL_MAX_RETRIES = get_env_int('MAIL_MAX_RETRIES', 5)
+MAIL_RETRY_BACKOFF = get_env_float('MAIL_RETRY_BACKOFF', 2.0)  # seconds, doubled per attempt
+MAIL_IDLE_TIMEOUT = get_env_float('MAIL_IDLE_TIMEOUT', 60.0)  # seconds before an idle SMTP session is closed
+MAIL_QUEUE_SIZE = get_env_int('MAIL_QUEUE_SIZE', 1000)
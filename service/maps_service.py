@@ -1,192 +1,776 @@
+import asyncio
+import base64
+import datetime
+import hashlib
+import json
 from fastapi import HTTPException
-import requests
-from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+import httpx
 import server_properties
 import logger
-from helper import utility
+from helper import utility, http_client, es_repository, geo, background, rate_limiter, metrics
+from helper.cache import TTLCache, create_cache
+from helper.singleflight import SingleFlight
+from helper.write_buffer import write_buffer
+from service import ranking
 
-log = logger.get_logger()
+log = logger.get_logger(__name__)
 
-api_key = server_properties.GOOGLE_API_KEY
-# Elasticsearch connection configuration
-es = Elasticsearch(
-    hosts=[server_properties.ES_HOST],
-    http_auth=(server_properties.ES_USER, server_properties.ES_PASSWORD)
-)
+# Geocoding results: in-process LRU or shared Redis cache (CACHE_BACKEND) in front of the
+# persistent geocode_cache index
+geocode_cache = create_cache('geocode', server_properties.GEOCODE_CACHE_MAX_ENTRIES, server_properties.GEOCODE_CACHE_TTL)
+metrics.register_cache('geocode', geocode_cache)
+
+# Freshness states of cached entries (stale-while-revalidate)
+CACHE_FRESH = 'fresh'
+CACHE_STALE = 'stale'
+CACHE_EXPIRED = 'expired'
+
+# In-flight upstream lookups, keyed by what they fetch, shared by concurrent callers
+_flights = SingleFlight()
+
+# Tiles fetched moments ago, kept until their restaurants and coverage have left the write-behind buffer
+recent_tiles = TTLCache(1000, max(5.0, 3 * server_properties.WRITE_BUFFER_FLUSH_INTERVAL))
+metrics.register_cache('recent_tiles', recent_tiles)
+
+def normalize_location(location):
+    return ' '.join(location.lower().split())
+
+def get_upstream_quota_stats():
+    return rate_limiter.stats()
+
+async def _call_google(api, url, params=None):
+    """
+    Call a Google API through its rate limiter and daily budget and return the decoded body.
+    Raises rate_limiter.UpstreamRefused when the call is refused; returns None when it fails or
+    Google reports an error status.
+    """
+    missing = server_properties.missing_settings('google')
+    if missing:
+        log.error(f"Skipped Google {api} API call: {', '.join(missing)} not set")
+        metrics.upstream_error('google', api)
+        return None
+    limiter = rate_limiter.limiters[api]
+    if not await limiter.acquire():
+        refused = limiter.refused()
+        log.warning(f"Skipped Google {api} API call: {refused}")
+        raise refused
+    try:
+        with metrics.upstream_call('google', api):
+            # Merged into the URL, which may already carry a query string of its own
+            request_url = httpx.URL(url).copy_merge_params({**(params or {}), 'key': server_properties.GOOGLE_API_KEY})
+            response = await http_client.get(str(request_url))
+    except httpx.HTTPError as e:
+        log.error(f"Error calling Google {api} API: {e}")
+        return None
+    log.debug("Response Status Code: %s", response.status_code)
+    try:
+        data = response.json()
+    except ValueError:
+        data = {}
+
+    status = data.get('status')
+    if response.status_code == 429 or status == 'OVER_QUERY_LIMIT':
+        metrics.upstream_error('google', api)
+        limiter.record_over_limit()
+        return None
+    if response.status_code != 200 or status not in (None, 'OK', 'ZERO_RESULTS'):
+        metrics.upstream_error('google', api)
+        log.error(f"Error from Google {api} API: {status or response.status_code} "
+                  f"{data.get('error_message', '')}")
+        return None
+    return data
+
+def _degraded(api):
+    # Running low on budget or backing off: serve cached data of any age instead of calling out
+    return rate_limiter.limiters[api].degraded()
+
+async def get_lat_long(location):
+    key = normalize_location(location)
+    cached = await geocode_cache.get(key)
+    if cached is not None:
+        # The shared cache stores JSON, which gives the pair back as a list
+        return tuple(cached)
+    with metrics.timed('geocode'):
+        return await _flights.do(('geocode', key), _resolve_lat_long, location, key)
+
+async def _resolve_lat_long(location, key):
+    cached, expired = await get_cached_lat_long(key)
+    metrics.cache_lookup('geocode', 'miss' if cached is None else CACHE_EXPIRED if expired else CACHE_FRESH)
+    if cached is not None and (not expired or _degraded(rate_limiter.GEOCODE)):
+        if expired:
+            rate_limiter.limiters[rate_limiter.GEOCODE].counters["degraded_served"] += 1
+        await geocode_cache.set(key, cached)
+        return cached
 
-def get_lat_long(location):
     url = server_properties.GOOGLE_GEOCODE_API_BASE_URL
-    params = {'address': location, 'key': api_key}
-    response = requests.get(url, params=params, verify=False)
-    log.info("Response Status Code: %s", response.status_code)
-    data = response.json()
+    params = {'address': location}
+    try:
+        data = await _call_google(rate_limiter.GEOCODE, url, params)
+    except rate_limiter.UpstreamRefused:
+        if cached is None:
+            raise
+        data = None
 
-    if response.status_code == 200 and 'results' in data and data['results']:
+    if data and data.get('results'):
         latitude = data['results'][0]['geometry']['location']['lat']
         longitude = data['results'][0]['geometry']['location']['lng']
+        await geocode_cache.set(key, (latitude, longitude))
+        await store_lat_long(key, latitude, longitude)
         return latitude, longitude
-    else:
-        return None, None
+    if data is None and cached is not None:
+        # Google could not be asked; an outdated position beats failing the search
+        rate_limiter.limiters[rate_limiter.GEOCODE].counters["degraded_served"] += 1
+        return cached
+    return None, None
+
+def _geocode_doc_id(key):
+    # Document ids are capped at 512 bytes, so key the persistent cache by a digest
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
 
-def find_nearby_restaurants(api_key, location, radius=5000, keyword='restaurant'):
-    log.info("Inside find_nearby_restaurants")
+async def get_cached_lat_long(key):
+    """
+    Return ((latitude, longitude), expired) from the persistent geocode cache, or (None, False).
+    """
+    doc = await es_repository.get_document(es_repository.GEOCODE_CACHE_INDEX, _geocode_doc_id(key))
+    if doc is None:
+        return None, False
+    cached_at = datetime.datetime.fromisoformat(doc['cached_at'])
+    expired = (datetime.datetime.utcnow() - cached_at).total_seconds() > server_properties.GEOCODE_ES_CACHE_TTL
+    return (doc['latitude'], doc['longitude']), expired
+
+async def store_lat_long(key, latitude, longitude):
+    document = {
+        "address": key,
+        "latitude": latitude,
+        "longitude": longitude,
+        "cached_at": datetime.datetime.utcnow().isoformat()
+    }
+    await write_buffer.add({
+        "_index": es_repository.GEOCODE_CACHE_INDEX,
+        "_id": _geocode_doc_id(key),
+        "_source": document
+    })
+
+async def find_nearby_restaurants(location, radius=5000, keyword='restaurant'):
+    """
+    Return (ranked restaurants, number of tiles that could not be fetched). Raises
+    rate_limiter.UpstreamRefused when Google was not called and there is nothing to return.
+    """
+    log.debug("Inside find_nearby_restaurants")
+    # Concurrent identical searches share one lookup and one upstream fetch
+    key = ('nearby', normalize_location(location), radius, keyword)
+    return await _flights.do(key, _find_nearby_restaurants, location, radius, keyword)
+
+async def _find_nearby_restaurants(location, radius, keyword):
 
     # First, try to get latitude and longitude for the given location
-    latitude, longitude = get_lat_long(location)
+    latitude, longitude = await get_lat_long(location)
     if latitude is None or longitude is None:
         raise HTTPException(status_code=400, detail="Error while fetching latitude or longitude")
 
-    # Check if nearby restaurants are cached in Elasticsearch
-    cached_restaurants = get_cached_nearby_restaurants(latitude, longitude, radius)
-    if cached_restaurants:
+    # Split the search circle into tiles and work out which ones earlier searches already fetched
+    tiles = plan_tiles(latitude, longitude, radius)
+    missing_tiles = await find_uncovered_tiles(latitude, longitude, tiles, keyword)
+
+    restaurants = {}
+    if len(missing_tiles) < len(tiles):
         log.info("Found cached restaurants.")
-        return cached_restaurants
+        for restaurant in await get_cached_nearby_restaurants(latitude, longitude, radius, keyword, len(tiles)):
+            restaurants[restaurant['id']] = restaurant
+
+    # Fetch only the uncovered tiles from Google API, concurrently, and merge them by place_id
+    unavailable, refused = 0, None
+    if missing_tiles:
+        log.info("Fetching %s of %s tiles from Google API near %s,%s...",
+                 len(missing_tiles), len(tiles), latitude, longitude)
+        fetched = await asyncio.gather(*(
+            fetch_tile_shared(tile, keyword) for tile in missing_tiles
+        ), return_exceptions=True)
+        for tile_restaurants in fetched:
+            if isinstance(tile_restaurants, rate_limiter.UpstreamRefused):
+                refused, tile_restaurants = tile_restaurants, None
+            elif isinstance(tile_restaurants, BaseException):
+                raise tile_restaurants
+            if tile_restaurants is None:
+                unavailable += 1
+                continue
+            for restaurant in tile_restaurants:
+                if _within_radius(restaurant, latitude, longitude, radius):
+                    restaurants.setdefault(restaurant['id'], restaurant)
+
+    if not restaurants:
+        # Nothing to show because Google could not be asked: tell the client when to retry
+        if refused is not None:
+            raise refused
+        log.info("Found 0 restaurants.")
+        return [], unavailable
+
+    # Rank by distance, ratings, popularity and our own users' reviews
+    return await rank_nearby_restaurants(list(restaurants.values()), latitude, longitude, radius), unavailable
+
+def _within_radius(restaurant, latitude, longitude, radius):
+    place_location = restaurant['location']
+    return place_location['lat'] is not None and geo.haversine_m(
+        latitude, longitude, place_location['lat'], place_location['lon']) <= radius
+
+async def open_nearby_restaurants_stream(location, radius=5000, keyword='restaurant'):
+    """
+    Geocode up front (so a bad location still fails with 400) and return an async generator
+    that yields cached restaurants first, then each uncovered tile's restaurants as it arrives.
+    When some tiles could not be fetched, the last item is {"partial": true, "unavailable_tiles": n}.
+    """
+    latitude, longitude = await get_lat_long(location)
+    if latitude is None or longitude is None:
+        raise HTTPException(status_code=400, detail="Error while fetching latitude or longitude")
+    return _stream_nearby_restaurants(latitude, longitude, radius, keyword)
+
+async def _stream_nearby_restaurants(latitude, longitude, radius, keyword):
+    tiles = plan_tiles(latitude, longitude, radius)
+    missing_tiles = await find_uncovered_tiles(latitude, longitude, tiles, keyword)
+    seen = set()
+    # Like the non-streaming search, at most RANK_TOP_K results in all (0 = all)
+    remaining = server_properties.RANK_TOP_K or None
+
+    # Each batch is ranked on its own: cached results first, then each fetched tile
+    if len(missing_tiles) < len(tiles):
+        cached = await get_cached_nearby_restaurants(latitude, longitude, radius, keyword, len(tiles))
+        for restaurant in await rank_nearby_restaurants(cached, latitude, longitude, radius, remaining):
+            seen.add(restaurant['id'])
+            yield restaurant
+        if remaining is not None:
+            remaining -= len(seen)
+            if remaining <= 0:
+                return
+
+    if not missing_tiles:
+        return
+    log.info("Streaming %s of %s tiles from Google API near %s,%s...",
+             len(missing_tiles), len(tiles), latitude, longitude)
+    tasks = [
+        asyncio.ensure_future(fetch_tile_shared(tile, keyword))
+        for tile in missing_tiles
+    ]
+    unavailable = 0
+    try:
+        for next_tile in asyncio.as_completed(tasks):
+            try:
+                tile_restaurants = await next_tile
+            except rate_limiter.UpstreamRefused:
+                tile_restaurants = None
+            if tile_restaurants is None:
+                unavailable += 1
+                continue
+            fresh = [
+                restaurant for restaurant in tile_restaurants
+                if restaurant['id'] not in seen and _within_radius(restaurant, latitude, longitude, radius)
+            ]
+            ranked = await rank_nearby_restaurants(fresh, latitude, longitude, radius, remaining)
+            for restaurant in ranked:
+                seen.add(restaurant['id'])
+                yield restaurant
+            if remaining is not None:
+                remaining -= len(ranked)
+                if remaining <= 0:
+                    return
+        if unavailable:
+            yield {"partial": True, "unavailable_tiles": unavailable}
+    finally:
+        # Done, or the client went away: stop waiting (shared fetches keep running for other callers)
+        for task in tasks:
+            task.cancel()
+
+async def rank_nearby_restaurants(restaurants, latitude, longitude, radius, top_k=None):
+    """
+    Rank restaurants and keep the best top_k of them (default RANK_TOP_K, 0 = all).
+    """
+    aggregates = await get_rating_aggregates([restaurant['id'] for restaurant in restaurants])
+    top_k = top_k or server_properties.RANK_TOP_K or None
+    with metrics.timed('ranking'):
+        return ranking.rank_restaurants(restaurants, latitude, longitude, radius, aggregates, top_k=top_k)
+
+def plan_tiles(latitude, longitude, radius):
+    """
+    Small searches are a single tile; wider ones are covered by geohash cells no wider than the
+    search itself nor than Places allows. When that takes more than MAX_TILES_PER_SEARCH cells,
+    the ones nearest the centre are fetched.
+    """
+    if radius <= server_properties.TILE_MIN_RADIUS:
+        return [geo.Tile(None, latitude, longitude, radius)]
+    max_tile_radius = min(radius, server_properties.MAX_SEARCH_RADIUS)
+    return geo.geohash_tiles(latitude, longitude, radius, server_properties.MAX_TILES_PER_SEARCH, max_tile_radius)
+
+def _coverage_id(tile, keyword):
+    if tile.geohash:
+        return f"{keyword}_{tile.geohash}"
+    center = geo.geohash_encode(tile.latitude, tile.longitude, geo.MAX_GEOHASH_PRECISION)
+    return f"{keyword}_{center}_{tile.radius}"
 
-    # If no cached restaurants, fetch from Google API
-    location_str = f"{latitude},{longitude}"
-    log.info(f"Fetching nearby restaurants from Google API near {location_str}...")
+def _cache_state(fetched_at, fresh_ttl, max_ttl):
+    """
+    Classify a cached entry by age: fresh entries are served as-is, stale ones are served
+    while a background refresh runs, expired ones are treated as misses.
+    """
+    age = (datetime.datetime.utcnow() - datetime.datetime.fromisoformat(fetched_at)).total_seconds()
+    if age <= fresh_ttl:
+        return CACHE_FRESH
+    if age <= max_ttl:
+        return CACHE_STALE
+    return CACHE_EXPIRED
+
+def _refresh_in_background(api, key, fn, *args):
+    # Stale-while-revalidate: refresh through the regular fetch path unless it is already running
+    if _degraded(api):
+        rate_limiter.limiters[api].counters["refreshes_skipped"] += 1
+        return
+    if not _flights.in_flight(key):
+        background.spawn(_refresh(key, fn, *args))
+
+async def _refresh(key, fn, *args):
+    try:
+        await _flights.do(key, fn, *args)
+    except rate_limiter.UpstreamRefused as e:
+        # The stale entry keeps being served; a later request tries again
+        log.info(f"Background refresh skipped: {e}")
+
+def _refresh_area(area):
+    tile = geo.Tile(area.get('geohash'), area['center']['lat'], area['center']['lon'], area['radius'])
+    # Fetched moments ago: its new coverage is still in the write-behind buffer, not yet in Elasticsearch
+    if recent_tiles.get((area['keyword'], tile)) is not None:
+        return
+    log.info("Refreshing stale coverage around %s,%s in the background", tile.latitude, tile.longitude)
+    _refresh_in_background(rate_limiter.NEARBY, ('tile', area['keyword'], tile), fetch_tile, tile, area['keyword'])
+
+async def fetch_tile_shared(tile, keyword):
+    # A tile fetched moments ago is not in Elasticsearch yet; reuse its result instead of fetching again
+    restaurants = recent_tiles.get((keyword, tile))
+    if restaurants is not None:
+        return restaurants
+    return await _flights.do(('tile', keyword, tile), fetch_tile, tile, keyword)
+
+async def fetch_tile(tile, keyword):
+    """
+    Fetch one tile from Places Nearby Search and cache its restaurants and coverage.
+    Returns None without recording coverage when the call fails, so the tile is retried later;
+    raises rate_limiter.UpstreamRefused when the call is refused.
+    """
+    radius = min(tile.radius, server_properties.MAX_SEARCH_RADIUS)
+    location_str = f"{tile.latitude},{tile.longitude}"
     url = utility.build_places_url(location_str, radius, keyword)
-    response = requests.get(url, verify=False)
-
-    log.info("Response Status Code: %s", response.status_code)
-    response_data = response.json()
-
-    if response.status_code == 200 and 'results' in response_data:
-        results = response_data['results']
-        if results:
-            restaurants = []
-            for place in results:
-                restaurant_info = {
-                    'name': place.get('name'),
-                    'address': place.get('vicinity'),
-                    'rating': place.get('rating'),
-                    'id': place.get('place_id'),
-                    'latitude': latitude,
-                    'longitude': longitude,
-                    'radius': radius
-                }
-                restaurants.append(restaurant_info)
-
-            # Store the fetched restaurants in Elasticsearch for future use
-            store_nearby_restaurants(restaurants, latitude, longitude, radius)
-
-            # Return sorted restaurants by rating (high to low)
-            sorted_data = sorted(restaurants, key=lambda x: x['rating'], reverse=True)
-            return sorted_data
-        else:
-            log.info("Found 0 restaurants.")
-            return []
+    response_data = await _call_google(rate_limiter.NEARBY, url)
+
+    if response_data is not None:
+        restaurants = []
+        for place in response_data.get('results', []):
+            place_location = place.get('geometry', {}).get('location', {})
+            restaurant_info = {
+                'name': place.get('name'),
+                'address': place.get('vicinity'),
+                'rating': place.get('rating'),
+                'user_ratings_total': place.get('user_ratings_total'),
+                'id': place.get('place_id'),
+                'latitude': place_location.get('lat'),
+                'longitude': place_location.get('lng'),
+                'radius': radius,
+                'keyword': keyword,
+                'location': {'lat': place_location.get('lat'), 'lon': place_location.get('lng')},
+                'fetched_at': datetime.datetime.utcnow().isoformat()
+            }
+            restaurants.append(restaurant_info)
+
+        # Store the fetched restaurants and the circle they cover for future use
+        await store_nearby_restaurants(restaurants)
+        # A capped fetch only covers the smaller circle around the tile centre, so that is what is recorded
+        covered = tile if radius == tile.radius else geo.Tile(None, tile.latitude, tile.longitude, radius)
+        # A full page is only a sample of the circle: it stands for this tile alone, not for searches inside it
+        await store_coverage(covered, radius, keyword, complete=len(restaurants) < server_properties.PLACES_PAGE_SIZE)
+        recent_tiles.set((keyword, tile), restaurants)
+        return restaurants
     else:
-        log.error(f"Error fetching restaurants: {response_data.get('error_message', 'Unknown error')}")
+        log.error(f"Error fetching restaurants near {location_str}, tile left uncovered")
+        return None
+
+# Return the tiles that no previous fetch has fully covered
+async def find_uncovered_tiles(latitude, longitude, tiles, keyword):
+    index_name = es_repository.RESTAURANT_COVERAGE_INDEX
+
+    # Tiles fetched before at the same place are found directly by id
+    covered = await es_repository.mget_documents(index_name, [_coverage_id(tile, keyword) for tile in tiles])
+    degraded = _degraded(rate_limiter.NEARBY)
+    remaining = []
+    for tile in tiles:
+        area = covered.get(_coverage_id(tile, keyword))
+        state = CACHE_EXPIRED
+        if area is not None:
+            state = _cache_state(area['fetched_at'], server_properties.NEARBY_FRESH_TTL, server_properties.NEARBY_CACHE_TTL)
+        if state == CACHE_STALE:
+            _refresh_area(area)
+        elif state == CACHE_EXPIRED and area is not None and degraded:
+            rate_limiter.limiters[rate_limiter.NEARBY].counters["degraded_served"] += 1
+        elif state == CACHE_EXPIRED:
+            remaining.append(tile)
+    if not remaining:
+        metrics.cache_lookup('nearby_tiles', 'hit', len(tiles))
         return []
 
-# Helper method to fetch cached restaurants from Elasticsearch
-def get_cached_nearby_restaurants(latitude, longitude, radius):
-    index_name = "restaurants"
+    # Otherwise a tile is covered when it lies inside any earlier fetched circle nearby that
+    # Google returned in full
+    filters = [
+        {"term": {"keyword": keyword}},
+        {"term": {"complete": True}},
+        {"range": {"radius": {"gte": min(tile.radius for tile in remaining)}}},
+        {"geo_distance": {
+            "distance": f"{server_properties.MAX_SEARCH_RADIUS}m",
+            "center": {"lat": latitude, "lon": longitude}
+        }}
+    ]
+    if not degraded:
+        filters.append({"range": {"fetched_at": {"gte": f"now-{server_properties.NEARBY_CACHE_TTL}s"}}})
     query = {
-        "query": {
-            "bool": {
-                "must": [
-                    {"match": {"latitude": latitude}},
-                    {"match": {"longitude": longitude}},
-                    {"match": {"radius": radius}}
-                ]
-            }
-        }
+        "size": server_properties.COVERAGE_CANDIDATES,
+        "query": {"bool": {"filter": filters}},
+        "sort": [
+            {"_geo_distance": {"center": {"lat": latitude, "lon": longitude}, "order": "asc", "unit": "m"}}
+        ]
+    }
+    response = await es_repository.search(index_name, query)
+    areas = [hit['_source'] for hit in response['hits']['hits']]
+    missing = []
+    for tile in remaining:
+        container = next((area for area in areas if geo.circle_contains(
+            area['center']['lat'], area['center']['lon'], area['radius'],
+            tile.latitude, tile.longitude, tile.radius)), None)
+        if container is None:
+            missing.append(tile)
+        elif _cache_state(container['fetched_at'], server_properties.NEARBY_FRESH_TTL,
+                          server_properties.NEARBY_CACHE_TTL) == CACHE_STALE:
+            _refresh_area(container)
+    metrics.cache_lookup('nearby_tiles', 'hit', len(tiles) - len(missing))
+    metrics.cache_lookup('nearby_tiles', 'miss', len(missing))
+    return missing
+
+# Record a fetched circle so repeated searches, and when complete the searches inside it,
+# can be served from cache
+async def store_coverage(tile, radius, keyword, complete):
+    index_name = es_repository.RESTAURANT_COVERAGE_INDEX
+    coverage = {
+        "center": {"lat": tile.latitude, "lon": tile.longitude},
+        "radius": radius,
+        "geohash": tile.geohash,
+        "keyword": keyword,
+        "complete": complete,
+        "fetched_at": datetime.datetime.utcnow().isoformat()
+    }
+    # Queued after the tile's restaurants, so both are written in the same order
+    await write_buffer.add({"_index": index_name, "_id": _coverage_id(tile, keyword), "_source": coverage})
+
+# Helper method to fetch cached restaurants from Elasticsearch: the nearest ones, as many as the
+# search's tiles can hold, so ranking sees the same candidates as when the tiles are fetched
+async def get_cached_nearby_restaurants(latitude, longitude, radius, keyword, tile_count=1):
+    index_name = es_repository.RESTAURANTS_INDEX
+    filters = [
+        {"term": {"keyword": keyword}},
+        {"geo_distance": {
+            "distance": f"{radius}m",
+            "location": {"lat": latitude, "lon": longitude}
+        }}
+    ]
+    # In degraded mode expired places are served too, matching the coverage they came with
+    if not _degraded(rate_limiter.NEARBY):
+        filters.append({"range": {"fetched_at": {"gte": f"now-{server_properties.NEARBY_CACHE_TTL}s"}}})
+    query = {
+        "size": max(server_properties.NEARBY_CACHE_MAX_RESULTS, tile_count * server_properties.PLACES_PAGE_SIZE),
+        "query": {"bool": {"filter": filters}},
+        "sort": [
+            {"_geo_distance": {"location": {"lat": latitude, "lon": longitude}, "order": "asc", "unit": "m"}}
+        ]
     }
-    response = es.search(index=index_name, body=query)
+    response = await es_repository.search(index_name, query)
     if response['hits']['total']['value'] > 0:
         restaurants = [hit['_source'] for hit in response['hits']['hits']]
         log.info("Returning cached restaurants.")
         return restaurants
     else:
         return []
-def store_nearby_restaurants(restaurant_data, latitude, longitude, radius):
-    index_name = "restaurants"
-    actions = []
+
+async def store_nearby_restaurants(restaurant_data):
+    index_name = es_repository.RESTAURANTS_INDEX
     
-    # Prepare actions for the bulk API
+    # Prepare actions for the bulk API; each restaurant keeps its own coordinates
     for restaurant in restaurant_data:
-        # Add the additional fields for latitude, longitude, and radius
-        restaurant['latitude'] = latitude
-        restaurant['longitude'] = longitude
-        restaurant['radius'] = radius
-
-        # Prepare the document action for the bulk API
+        # Prepare the document action for the bulk API, one document per place and keyword
         action = {
             "_op_type": "index",  # Operation type: "index" means create or replace
             "_index": index_name,
+            "_id": f"{restaurant['keyword']}_{restaurant['id']}",
             "_source": restaurant
         }
-        actions.append(action)
+        # Written to Elasticsearch in batches by the write-behind buffer
+        await write_buffer.add(action)
     
-    # Perform the bulk insert into Elasticsearch
-    if actions:
-        success, failed = bulk(es, actions)
-        log.info(f"Bulk insert completed. {success} documents indexed, {failed} failed.")
-    else:
+    if not restaurant_data:
         log.info("No restaurants to index.")
 
-def get_restaurant_details(api_key, restaurant_id):
+async def get_restaurant_details(restaurant_id):
+    # Concurrent requests for the same place share one lookup and one upstream fetch
+    return await _flights.do(('details', restaurant_id), _get_restaurant_details, restaurant_id)
+
+async def _get_restaurant_details(restaurant_id):
     # First, check if restaurant details are already cached in Elasticsearch
-    cached_details = get_cached_restaurant_details(restaurant_id)
+    cached_details = await get_cached_restaurant_details(restaurant_id)
     if cached_details:
-        log.info(f"Found cached details for restaurant ID: {restaurant_id}")
+        log.info("Found cached details for restaurant ID: %s", restaurant_id)
         return cached_details
     
     # If not cached, fetch the details from Google Places API
-    log.info(f"Fetching details for restaurant ID: {restaurant_id} from Google API...")
-    url = f"https://maps.googleapis.com/maps/api/place/details/json?place_id={restaurant_id}&key={api_key}"
-    response = requests.get(url, verify=False)
-
-    if response.status_code == 200:
-        details = response.json().get('result', {})
-        
+    details = await _flights.do(('details_fetch', restaurant_id), fetch_restaurant_details, restaurant_id)
+    if details:
         # Store the fetched details in Elasticsearch for future use
-        store_restaurant_details(details)
-        
-        return details
+        await store_restaurant_details(details, restaurant_id)
+    return details
+
+async def fetch_restaurant_details(restaurant_id):
+    log.info("Fetching details for restaurant ID: %s from Google API...", restaurant_id)
+    url = server_properties.GOOGLE_PLACE_DETAILS_API_BASE_URL
+    params = {'place_id': restaurant_id}
+    data = await _call_google(rate_limiter.DETAILS, url, params)
+
+    if data is not None:
+        return data.get('result', {})
     else:
-        log.error(f"Error fetching details for restaurant ID {restaurant_id}: {response.content}")
+        log.error(f"Error fetching details for restaurant ID {restaurant_id}")
         return {}
-    
 
-def store_restaurant_details(restaurant_details):
-    # Index the restaurant details in Elasticsearch
-    index_name = "restaurants_details"
-    restaurant_id = restaurant_details.get('place_id')
+async def get_restaurant_details_batch(restaurant_ids):
+    """
+    Resolve many restaurants at once: cached ones with one mget, misses from Google
+    concurrently, written back with one bulk request. Returns ({restaurant_id: details}, the ids
+    whose Google call was refused).
+    """
+    restaurant_ids = list(dict.fromkeys(restaurant_ids))
+    index_name = es_repository.RESTAURANT_DETAILS_INDEX
+
+    documents = {}
+    for restaurant_id in restaurant_ids:
+        pending = write_buffer.pending_source(index_name, restaurant_id)
+        if pending is not None:
+            documents[restaurant_id] = dict(pending)
+    unbuffered = [restaurant_id for restaurant_id in restaurant_ids if restaurant_id not in documents]
+    found = await es_repository.mget_documents(index_name, unbuffered)
+    metrics.cache_lookup('details', 'miss', len(unbuffered) - len(found))
+    documents.update(found)
+
+    details_by_id = {}
+    for restaurant_id, document in documents.items():
+        cached_details = _details_from_cache(restaurant_id, document)
+        if cached_details is not None:
+            details_by_id[restaurant_id] = cached_details
+
+    misses = [restaurant_id for restaurant_id in restaurant_ids if restaurant_id not in details_by_id]
+    unavailable = []
+    log.info("Found %s cached details, fetching %s from Google API...", len(details_by_id), len(misses))
+    if misses:
+        fetched = await asyncio.gather(*(
+            _flights.do(('details_fetch', restaurant_id), fetch_restaurant_details, restaurant_id)
+            for restaurant_id in misses
+        ), return_exceptions=True)
+        fetched_by_id = {}
+        for restaurant_id, details in zip(misses, fetched):
+            if isinstance(details, rate_limiter.UpstreamRefused):
+                unavailable.append(restaurant_id)
+            elif isinstance(details, BaseException):
+                raise details
+            elif details:
+                fetched_by_id[restaurant_id] = details
+        await store_restaurant_details_bulk(fetched_by_id)
+        details_by_id.update(fetched_by_id)
+
+    return {restaurant_id: details_by_id.get(restaurant_id, {}) for restaurant_id in restaurant_ids}, unavailable
+
+async def store_restaurant_details(restaurant_details, restaurant_id=None):
+    # Index the restaurant details in Elasticsearch, keyed by the place id they were requested with
+    index_name = es_repository.RESTAURANT_DETAILS_INDEX
+    restaurant_id = restaurant_id or restaurant_details.get('place_id')
     if restaurant_id:
-        es.index(index=index_name, id=restaurant_id, document=restaurant_details)
-        log.info(f"Stored restaurant details for {restaurant_id} in Elasticsearch.")
+        document = {**restaurant_details, 'cached_at': datetime.datetime.utcnow().isoformat()}
+        await write_buffer.add({"_index": index_name, "_id": restaurant_id, "_source": document})
+        log.info("Queued restaurant details for %s for Elasticsearch.", restaurant_id)
 
-# Get restaurant details from Elasticsearch (cached)
-def get_cached_restaurant_details(restaurant_id):
-    index_name = "restaurants_details"
-    query = {
-        "query": {
-            "match": {
-                "restaurant_id": restaurant_id
+async def store_restaurant_details_bulk(details_by_id):
+    index_name = es_repository.RESTAURANT_DETAILS_INDEX
+    cached_at = datetime.datetime.utcnow().isoformat()
+    for restaurant_id, details in details_by_id.items():
+        await write_buffer.add({
+            "_op_type": "index",
+            "_index": index_name,
+            "_id": restaurant_id,
+            "_source": {**details, 'cached_at': cached_at}
+        })
+
+def _details_from_cache(restaurant_id, document):
+    """
+    Strip cache metadata from a stored details document, or return None once it has expired
+    (unless the details API is degraded). Stale details are still returned, and refreshed in the background.
+    """
+    cached_at = document.pop('cached_at', '1970-01-01T00:00:00')
+    state = _cache_state(cached_at, server_properties.DETAILS_FRESH_TTL, server_properties.DETAILS_CACHE_TTL)
+    metrics.cache_lookup('details', state)
+    if state == CACHE_EXPIRED:
+        if not _degraded(rate_limiter.DETAILS):
+            return None
+        rate_limiter.limiters[rate_limiter.DETAILS].counters["degraded_served"] += 1
+    if state == CACHE_STALE:
+        log.info("Refreshing stale details for restaurant ID: %s in the background", restaurant_id)
+        _refresh_in_background(rate_limiter.DETAILS, ('details_refresh', restaurant_id),
+                               _refresh_restaurant_details, restaurant_id)
+    return document
+
+async def _refresh_restaurant_details(restaurant_id):
+    details = await _flights.do(('details_fetch', restaurant_id), fetch_restaurant_details, restaurant_id)
+    if details:
+        await store_restaurant_details(details, restaurant_id)
+
+# Get restaurant details from Elasticsearch (cached) with a single get-by-id
+async def get_cached_restaurant_details(restaurant_id):
+    index_name = es_repository.RESTAURANT_DETAILS_INDEX
+    # Details fetched moments ago may still be waiting in the write-behind buffer
+    document = write_buffer.pending_source(index_name, restaurant_id)
+    if document is not None:
+        return _details_from_cache(restaurant_id, dict(document))
+    document = await es_repository.get_document(index_name, restaurant_id)
+    if document is None:
+        metrics.cache_lookup('details', 'miss')
+        return None
+    return _details_from_cache(restaurant_id, document)
+
+# Writes a review and records the rating it replaced, which is returned with the write result.
+# Resubmitting the same rating and text is a no-op.
+REVIEW_WRITE_SCRIPT = """
+    Object previous = ctx._source.rating;
+    if (previous != null && ((Number) previous).doubleValue() == params.review.rating
+            && params.review.review_text.equals(ctx._source.review_text)) {
+        ctx.op = 'noop';
+        return;
+    }
+    ctx._source.putAll(params.review);
+    ctx._source.previous_rating = previous;
+"""
+
+# Store reviews in Elasticsearch, one document per review_id, and fold them into the rating aggregate
+async def store_user_review(review_data):
+    index_name = es_repository.USER_REVIEWS_INDEX
+    review_id = review_data['review_id']
+    # Written directly rather than through the write-behind buffer: the previous rating in the
+    # result is what lets a changed review replace its old rating in the aggregate
+    response = await es_repository.update_document(index_name, review_id, {
+        "scripted_upsert": True,
+        "script": {"source": REVIEW_WRITE_SCRIPT, "lang": "painless", "params": {"review": review_data}},
+        "upsert": {},
+        "_source": ["previous_rating"],
+    }, retry_on_conflict=3)
+    if response['result'] != 'noop':
+        previous = response['get']['_source'].get('previous_rating')
+        # Each write of the review is applied once, however often the aggregate update is retried
+        write_id = f"{review_id}:{response['_primary_term']}:{response['_seq_no']}"
+        await update_rating_aggregate(review_data['restaurant_id'], write_id, previous, review_data['rating'])
+    log.info("Stored review for user %s at restaurant %s.", review_data['user_id'], review_data['restaurant_id'])
+    return {"_id": review_id, "result": response['result']}
+
+# Moves one review's contribution from its previous rating (if any) to the new one. The aggregate
+# keeps only the ids of its last few writes, enough to recognise a retried update.
+RATING_AGGREGATE_SCRIPT = """
+    List recent = ctx._source.recent;
+    if (recent == null) {
+        recent = new ArrayList();
+        ctx._source.recent = recent;
+    }
+    if (recent.contains(params.write_id)) {
+        ctx.op = 'noop';
+        return;
+    }
+    recent.add(params.write_id);
+    if (recent.size() > params.max_recent) {
+        ctx._source.recent = new ArrayList(recent.subList(recent.size() - params.max_recent, recent.size()));
+    }
+    ctx._source.remove('reviews');
+    if (params.previous != null) {
+        String oldStar = String.valueOf(Math.round(params.previous));
+        ctx._source.count -= 1;
+        ctx._source.sum -= params.previous;
+        ctx._source.histogram[oldStar] = ctx._source.histogram.getOrDefault(oldStar, 1) - 1;
+    }
+    ctx._source.count += 1;
+    ctx._source.sum += params.rating;
+    ctx._source.histogram[params.star] = ctx._source.histogram.getOrDefault(params.star, 0) + 1;
+    ctx._source.updated_at = params.updated_at;
+"""
+RATING_AGGREGATE_MAX_RECENT = 50
+
+def rating_aggregate_update(restaurant_id, write_id, previous, rating):
+    return {
+        "scripted_upsert": True,
+        "script": {
+            "source": RATING_AGGREGATE_SCRIPT,
+            "lang": "painless",
+            "params": {
+                "write_id": write_id,
+                "previous": None if previous is None else float(previous),
+                "rating": float(rating),
+                "star": str(int(rating + 0.5)),  # Rounds half up, like Math.round in the script
+                "max_recent": RATING_AGGREGATE_MAX_RECENT,
+                "updated_at": datetime.datetime.utcnow().isoformat()
             }
-        }
+        },
+        "upsert": empty_rating_aggregate(restaurant_id)
     }
-    response = es.search(index=index_name, body=query)
-    if response['hits']['total']['value'] > 0:
-        return response['hits']['hits'][0]['_source']
-    else:
-        return None
 
-# Store reviews in Elasticsearch
-def store_user_review(review_data):
-    index_name = "user_reviews"
-    response = es.index(index=index_name, document=review_data)
-    log.info(f"Stored review for user {review_data['user_id']} at restaurant {review_data['restaurant_id']}.")
-    return response
+def empty_rating_aggregate(restaurant_id):
+    return {
+        "restaurant_id": restaurant_id,
+        "count": 0,
+        "sum": 0.0,
+        "histogram": {str(star): 0 for star in range(1, 6)},
+        "recent": []
+    }
+
+async def update_rating_aggregate(restaurant_id, write_id, previous, rating):
+    index_name = es_repository.RESTAURANT_RATINGS_INDEX
+    await write_buffer.add({
+        "_op_type": "update",
+        "_index": index_name,
+        "_id": restaurant_id,
+        "retry_on_conflict": 5,
+        **rating_aggregate_update(restaurant_id, write_id, previous, rating)
+    })
+
+# Bookkeeping fields of the aggregates; older aggregates also carry a per-review ratings map
+# until their next update
+RATING_AGGREGATE_EXCLUDES = ["recent", "reviews"]
+
+# Read review counts and rating sums for many restaurants with one mget
+async def get_rating_aggregates(restaurant_ids):
+    index_name = es_repository.RESTAURANT_RATINGS_INDEX
+    documents = await es_repository.mget_documents(index_name, restaurant_ids,
+                                                   source_excludes=RATING_AGGREGATE_EXCLUDES)
+    return {restaurant_id: (doc['count'], doc['sum']) for restaurant_id, doc in documents.items()}
+
+# Read a restaurant's rating summary from its aggregate document
+async def get_rating_summary(restaurant_id):
+    index_name = es_repository.RESTAURANT_RATINGS_INDEX
+    aggregate = await es_repository.get_document(index_name, restaurant_id, source_excludes=RATING_AGGREGATE_EXCLUDES)
+    if aggregate is None or not aggregate['count']:
+        return {"restaurant_id": restaurant_id, "count": 0, "average": None,
+                "histogram": {str(star): 0 for star in range(1, 6)}}
+    return {
+        "restaurant_id": restaurant_id,
+        "count": aggregate['count'],
+        "average": round(aggregate['sum'] / aggregate['count'], 2),
+        "histogram": aggregate['histogram']
+    }
 
-def fetch_restaurant_reviews(api_key, restaurant_id):
+async def fetch_restaurant_reviews(restaurant_id):
     # Fetch restaurant details using the existing method
-    result = get_restaurant_details(api_key, restaurant_id)
-    log.info("Response received from get_restaurant_details method", result)
+    result = await get_restaurant_details(restaurant_id)
+    log.debug("Response received from get_restaurant_details for %s", restaurant_id)
 
     # Extract the relevant data
     if 'reviews' in result and result['reviews']:
@@ -214,44 +798,71 @@ def fetch_restaurant_reviews(api_key, restaurant_id):
 
 
 # Store restaurant reviews in Elasticsearch
-def store_restaurant_review(review_data):
-    index_name = "restaurant_reviews"
-    response = es.index(index=index_name, document=review_data)
-    return response
-
-# Store user favorites in Elasticsearch
-def store_user_favorite(favorite_data):
-    index_name = "user_favorites"
-    response = es.index(index=index_name, document=favorite_data)
-    return response
-
-# Fetch user favorites from Elasticsearch
-def fetch_user_favorites(user_id):
-    index_name = "user_favorites"
-    query = {
-        "query": {
-            "match": {
-                "user_id": user_id
-            }
-        }
-    }
-    response = es.search(index=index_name, body=query)
-    return response['hits']['hits']
+async def store_restaurant_review(review_data):
+    index_name = es_repository.RESTAURANT_REVIEWS_INDEX
+    await write_buffer.add({"_index": index_name, "_source": review_data})
+    return {"result": "queued"}
+
+# Store user favorites in Elasticsearch, once per favorite_id; repeated adds are no-ops
+async def store_user_favorite(favorite_data):
+    index_name = es_repository.USER_FAVORITES_INDEX
+    favorite_id = favorite_data['favorite_id']
+    # op_type create: if the favorite already exists the write is dropped as a no-op
+    await write_buffer.add({"_op_type": "create", "_index": index_name, "_id": favorite_id, "_source": favorite_data})
+    return {"_id": favorite_id, "result": "queued"}
+
+# Fields returned to clients for favorites and reviews pages
+FAVORITE_FIELDS = ["favorite_id", "user_id", "restaurant_id", "added_at"]
+REVIEW_FIELDS = ["review_id", "user_id", "restaurant_id", "rating", "review_text", "created_at"]
+
+def encode_cursor(sort_values):
+    return base64.urlsafe_b64encode(json.dumps(sort_values).encode('utf-8')).decode('ascii')
 
-def fetch_reviews_by_restaurant(restaurant_id):
-    index_name = "user_reviews"
+def decode_cursor(cursor):
+    try:
+        sort_values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, UnicodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    # The listings sort by (date, id): the date comes back from Elasticsearch as epoch millis
+    if not (isinstance(sort_values, list) and len(sort_values) == 2
+            and isinstance(sort_values[0], int) and not isinstance(sort_values[0], bool)
+            and isinstance(sort_values[1], str)):
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    return sort_values
+
+async def _search_page(index_name, term, sort, fields, size, cursor):
+    """
+    Fetch one page of a keyword-filtered query using search_after.
+    Returns (documents, next_cursor); next_cursor is None on the last page.
+    """
     query = {
-        "query": {
-            "match": {
-                "restaurant_id": restaurant_id
-            }
-        }
+        "size": size,
+        "query": {"bool": {"filter": [{"term": term}]}},
+        "sort": sort,
+        "_source": fields,
+        "track_total_hits": False
     }
-    response = es.search(index=index_name, body=query)
-    if response['hits']['total']['value'] > 0:
-        reviews = [hit['_source'] for hit in response['hits']['hits']]
-        log.info(f"Found {len(reviews)} reviews for restaurant {restaurant_id}.")
-        return reviews
+    if cursor:
+        query["search_after"] = decode_cursor(cursor)
+    response = await es_repository.search(index_name, query)
+    hits = response['hits']['hits']
+    next_cursor = encode_cursor(hits[-1]['sort']) if len(hits) == size else None
+    return [hit['_source'] for hit in hits], next_cursor
+
+# Fetch a page of user favorites from Elasticsearch, newest first
+async def fetch_user_favorites(user_id, size=20, cursor=None):
+    index_name = es_repository.USER_FAVORITES_INDEX
+    sort = [{"added_at": "desc"}, {"favorite_id": "asc"}]
+    return await _search_page(index_name, {"user_id": user_id}, sort, FAVORITE_FIELDS, size, cursor)
+
+# Fetch a page of user reviews for a restaurant from Elasticsearch, newest first
+async def fetch_reviews_by_restaurant(restaurant_id, size=20, cursor=None):
+    index_name = es_repository.USER_REVIEWS_INDEX
+    sort = [{"created_at": "desc"}, {"review_id": "asc"}]
+    reviews, next_cursor = await _search_page(index_name, {"restaurant_id": restaurant_id}, sort,
+                                              REVIEW_FIELDS, size, cursor)
+    if reviews:
+        log.info("Found %s reviews for restaurant %s.", len(reviews), restaurant_id)
     else:
-        log.info(f"No reviews found for restaurant {restaurant_id}.")
-        return []
\ No newline at end of file
+        log.info("No reviews found for restaurant %s.", restaurant_id)
+    return reviews, next_cursor
@@ -0,0 +1,125 @@
+# One-off data migrations between index layouts.
+# Run from the project root with:  python -m service.migrations
+import asyncio
+
+import logger
+from helper import es_repository
+from service import maps_service
+from service.user_service import normalize_email
+
+log = logger.get_logger(__name__)
+
+
+async def migrate_users():
+    """
+    Copy users from the legacy randomly-keyed index into the email-keyed users index and
+    the user_ids lookup index. When an email was registered more than once, the earliest
+    signup wins. Safe to re-run: users already migrated are left untouched.
+    """
+    if not await es_repository.index_exists(es_repository.LEGACY_USERS_INDEX):
+        log.info("No legacy users index to migrate.")
+        return
+    users = {}
+    async for hit in es_repository.scan(es_repository.LEGACY_USERS_INDEX):
+        user_data = hit['_source']
+        if not user_data.get('email') or not user_data.get('user_id'):
+            continue
+        key = normalize_email(user_data['email'])
+        if key not in users or user_data.get('created_at', '') < users[key].get('created_at', ''):
+            users[key] = user_data
+
+    actions = []
+    for key, user_data in users.items():
+        actions.append({"_op_type": "create", "_index": es_repository.USERS_INDEX, "_id": key, "_source": user_data})
+        actions.append({"_op_type": "index", "_index": es_repository.USER_IDS_INDEX,
+                        "_id": user_data['user_id'], "_source": {"email": key}})
+    if actions:
+        # Conflicts mean the user already exists in the new index, which is expected on re-runs
+        success, errors = await es_repository.bulk(actions, raise_on_error=False)
+        conflicts = [error for error in errors if error.get('create', {}).get('status') == 409]
+        log.info(f"Migrated users: {success} written, {len(conflicts)} already present, "
+                 f"{len(errors) - len(conflicts)} failed.")
+    else:
+        log.info("No legacy users to migrate.")
+
+
+async def dedupe_by_natural_id(target_index, source_indices, id_field, time_field, keep_latest):
+    """
+    Rewrite favorites or reviews so each natural id (favorite_id / review_id) is stored once,
+    as the document _id in the target index. Of duplicates, the earliest or latest by time_field
+    is kept; documents in the target index under any other _id are deleted.
+    Returns the documents kept. Safe to re-run.
+    """
+    chosen = {}
+    stray_ids = []
+    for index in source_indices:
+        if not await es_repository.index_exists(index):
+            log.info(f"No index {index} to deduplicate.")
+            continue
+        async for hit in es_repository.scan(index):
+            document = hit['_source']
+            natural_id = document.get(id_field)
+            if index == target_index and hit['_id'] != natural_id:
+                stray_ids.append(hit['_id'])
+            if not natural_id:
+                continue
+            current = chosen.get(natural_id)
+            if current is None or (document.get(time_field, '') > current.get(time_field, '')) == keep_latest:
+                chosen[natural_id] = document
+
+    actions = [
+        {"_op_type": "index", "_index": target_index, "_id": natural_id, "_source": document}
+        for natural_id, document in chosen.items()
+    ]
+    actions += [{"_op_type": "delete", "_index": target_index, "_id": stray_id} for stray_id in stray_ids]
+    if actions:
+        success, errors = await es_repository.bulk(actions, raise_on_error=False)
+        log.info(f"Deduplicated {target_index}: {len(chosen)} unique documents, "
+                 f"{len(stray_ids)} duplicates removed, {len(errors)} failed.")
+    return list(chosen.values())
+
+
+async def rebuild_rating_aggregates(reviews):
+    """
+    Recompute every restaurant's rating aggregate from its reviews and overwrite the stored one.
+    Safe to re-run; reviews added while it runs may need another run.
+    """
+    aggregates = {}
+    for review in reviews:
+        if not review.get('restaurant_id') or review.get('rating') is None:
+            continue
+        aggregate = aggregates.setdefault(review['restaurant_id'],
+                                          maps_service.empty_rating_aggregate(review['restaurant_id']))
+        star = str(int(review['rating'] + 0.5))
+        aggregate['count'] += 1
+        aggregate['sum'] += float(review['rating'])
+        aggregate['histogram'][star] = aggregate['histogram'].get(star, 0) + 1
+    actions = [
+        {"_op_type": "index", "_index": es_repository.RESTAURANT_RATINGS_INDEX, "_id": restaurant_id,
+         "_source": aggregate}
+        for restaurant_id, aggregate in aggregates.items()
+    ]
+    if actions:
+        success, errors = await es_repository.bulk(actions, raise_on_error=False)
+        log.info(f"Rebuilt rating aggregates: {success} restaurants written, {len(errors)} failed.")
+
+
+async def main():
+    await es_repository.ensure_indices()
+    try:
+        await migrate_users()
+        await dedupe_by_natural_id(
+            es_repository.USER_FAVORITES_INDEX,
+            [es_repository.LEGACY_USER_FAVORITES_INDEX, es_repository.USER_FAVORITES_INDEX],
+            id_field='favorite_id', time_field='added_at', keep_latest=False)
+        reviews = await dedupe_by_natural_id(
+            es_repository.USER_REVIEWS_INDEX,
+            [es_repository.LEGACY_USER_REVIEWS_INDEX, es_repository.USER_REVIEWS_INDEX],
+            id_field='review_id', time_field='created_at', keep_latest=True)
+        await rebuild_rating_aggregates(reviews)
+    finally:
+        await es_repository.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
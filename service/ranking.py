@@ -0,0 +1,78 @@
+import numpy as np
+
+import server_properties
+from helper.geo import EARTH_RADIUS_M
+
+# Weights of each signal in the final score; they need not sum to one
+DEFAULT_WEIGHTS = {
+    "distance": server_properties.RANK_WEIGHT_DISTANCE,
+    "rating": server_properties.RANK_WEIGHT_RATING,
+    "popularity": server_properties.RANK_WEIGHT_POPULARITY,
+    "reviews": server_properties.RANK_WEIGHT_REVIEWS,
+}
+
+
+def haversine_m(latitude, longitude, latitudes, longitudes):
+    """
+    Vectorised great-circle distance in metres from one point to arrays of points.
+    """
+    phi1 = np.radians(latitude)
+    phi2 = np.radians(latitudes)
+    d_phi = phi2 - phi1
+    d_lambda = np.radians(longitudes - longitude)
+    a = np.sin(d_phi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def rank_restaurants(restaurants, latitude, longitude, radius, aggregates=None, weights=None, top_k=None):
+    """
+    Score candidates in one vectorised pass and return the top_k best, highest score first.
+
+    Signals, each scaled to [0, 1]:
+      distance   - 1 at the search centre, 0 at the edge of the radius
+      rating     - Google rating / 5 (missing ratings get the prior)
+      popularity - log of user_ratings_total, relative to the most reviewed candidate
+      reviews    - our own users' average rating / 5, shrunk towards the Google rating
+                   until RANK_REVIEWS_PRIOR_COUNT reviews have been collected
+    aggregates maps restaurant id to (review_count, rating_sum) from the rating aggregates.
+    Each returned restaurant is a copy with 'distance' (metres) and 'score' added.
+    """
+    if not restaurants:
+        return []
+    weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+    aggregates = aggregates or {}
+
+    latitudes = np.array([r['location']['lat'] for r in restaurants], dtype=float)
+    longitudes = np.array([r['location']['lon'] for r in restaurants], dtype=float)
+    ratings = np.array([r.get('rating') if r.get('rating') is not None else np.nan for r in restaurants], dtype=float)
+    totals = np.array([r.get('user_ratings_total') or 0 for r in restaurants], dtype=float)
+    own = np.array([aggregates.get(r['id'], (0, 0.0)) for r in restaurants], dtype=float).reshape(-1, 2)
+    own_counts, own_sums = own[:, 0], own[:, 1]
+
+    distances = haversine_m(latitude, longitude, latitudes, longitudes)
+    distance_score = 1.0 - np.clip(distances / max(radius, 1), 0.0, 1.0)
+
+    rating_score = np.nan_to_num(ratings, nan=server_properties.RANK_RATING_PRIOR) / 5.0
+
+    max_total = totals.max()
+    popularity_score = np.log1p(totals) / np.log1p(max_total) if max_total > 0 else np.zeros_like(totals)
+
+    prior = server_properties.RANK_REVIEWS_PRIOR_COUNT
+    reviews_score = (own_sums / 5.0 + prior * rating_score) / (own_counts + prior)
+
+    scores = (weights["distance"] * distance_score
+              + weights["rating"] * rating_score
+              + weights["popularity"] * popularity_score
+              + weights["reviews"] * reviews_score)
+
+    # Select the top_k without sorting every candidate, then order just those
+    if top_k and top_k < len(restaurants):
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        candidates = np.arange(len(restaurants))
+    order = candidates[np.argsort(-scores[candidates], kind='stable')]
+
+    return [
+        {**restaurants[i], 'distance': round(float(distances[i])), 'score': round(float(scores[i]), 4)}
+        for i in order
+    ]
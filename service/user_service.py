@@ -1,78 +1,84 @@
-import bcrypt
 import uuid
 import datetime
 from datetime import timedelta
 import jwt
-from elasticsearch import Elasticsearch
 import server_properties
 import logging
-from helper import notification
+from helper import notification, es_repository, metrics
+from helper.cache import create_cache
+from helper.passwords import password_hasher
 
 log = logging.getLogger(__name__)
 
-# Elasticsearch connection configuration
-es = Elasticsearch(
-    hosts=[server_properties.ES_HOST],
-    http_auth=(server_properties.ES_USER, server_properties.ES_PASSWORD)
-)
+USER_INDEX = es_repository.USERS_INDEX
+USER_IDS_INDEX = es_repository.USER_IDS_INDEX
 
-log.info("Connected to Elasticsearch")
-USER_INDEX = "users"
+# Short-lived cache in front of the user gets; entries are dropped when the user is updated,
+# in every worker when the cache is shared (CACHE_BACKEND=redis). Password hashes are never
+# cached: login reads them straight from Elasticsearch.
+user_cache = create_cache('user', server_properties.USER_CACHE_MAX_ENTRIES, server_properties.USER_CACHE_TTL)
+metrics.register_cache('user', user_cache)
 
-# JWT Configuration
-SECRET_KEY = server_properties.SECRET_KEY  # Use a strong secret key in production
-ALGORITHM = server_properties.ALGORITHM
+# JWT Configuration (SECRET_KEY and ALGORITHM are read from server_properties when a token is made)
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-# Password hashing functions
-def hash_password(password: str) -> str:
-    """
-    Hash the password using bcrypt
-    """
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-
-def verify_password(stored_hash: str, password: str) -> bool:
-    """
-    Verify the password with the stored hashed password
-    """
-    return bcrypt.checkpw(password.encode('utf-8'), stored_hash.encode('utf-8'))
-
 def create_access_token(user_id: str):
     """
     Create an access token for the user with user_id in the payload.
     """
     expires = datetime.datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode = {"user_id": user_id, "exp": expires}
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = jwt.encode(to_encode, server_properties.SECRET_KEY, algorithm=server_properties.ALGORITHM)
     return encoded_jwt
 
 
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+
 class UserService:
+    """
+    Users are stored under deterministic ids: the users index is keyed by normalised email and
+    the user_ids index maps user_id to that email, so every lookup is a primary-key get.
+    """
     def __init__(self):
-        self.es = es
         self.index = USER_INDEX
+        self.id_index = USER_IDS_INDEX
+        self.cache = user_cache
 
-    def signup(self, username: str, password: str, email: str):
+    async def get_user_by_email(self, email: str):
+        """
+        The user's profile, without the password hash.
+        """
+        key = normalize_email(email)
+        user_data = await self.cache.get(('email', key))
+        if user_data is None:
+            user_data = await es_repository.get_document(self.index, key)
+            if user_data is not None:
+                user_data = {k: v for k, v in user_data.items() if k != 'password'}
+                await self.cache.set(('email', key), user_data)
+        return user_data
+
+    async def get_email_by_user_id(self, user_id: str):
+        email = await self.cache.get(('user_id', user_id))
+        if email is None:
+            document = await es_repository.get_document(self.id_index, user_id)
+            if document is not None:
+                email = document['email']
+                await self.cache.set(('user_id', user_id), email)
+        return email
+
+    async def signup(self, username: str, password: str, email: str):
         """
         Handle user signup.
         Checks if the email already exists, hashes the password, and stores the user data in Elasticsearch.
         """
         # Check if the user already exists based on email
-        query = {
-            "query": {
-                "term": {
-                    "email": email
-                }
-            }
-        }
-
-        res = self.es.search(index=self.index, body=query)
-
-        if res['hits']['total']['value'] > 0:
+        if await self.get_user_by_email(email) is not None:
             return {"success": False, "error": "User already exists"}
 
         # Hash the password before storing it
-        hashed_password = hash_password(password)
+        hashed_password = await password_hasher.hash(password)
 
         # Prepare user data for Elasticsearch document
         user_data = {
@@ -83,85 +89,80 @@ class UserService:
             "created_at": datetime.datetime.utcnow().isoformat(),
         }
 
-        # Index the user document in Elasticsearch
-        self.es.index(index=self.index, document=user_data)
+        # Create the user document keyed by email; a concurrent duplicate signup fails here
+        try:
+            await es_repository.create_document(self.index, normalize_email(email), user_data)
+        except es_repository.ConflictError:
+            return {"success": False, "error": "User already exists"}
+        # Without its user_id mapping the user could log in but not be found by id, so undo the
+        # signup when that write fails; the email can then be registered again
+        try:
+            await es_repository.index_document(self.id_index, {"email": normalize_email(email)}, id=user_data["user_id"])
+        except Exception:
+            log.exception("Could not store the user_id of a new user; removing the user")
+            await es_repository.delete_document(self.index, normalize_email(email))
+            raise
 
         # Send welcome notification
         subject = "Welcome! Your Guide to Local Restaurants is Here!"
         body = f"Hello {username},\n\nThank you for signing up! We're excited to have you on board."
-        print("subject",subject,"body ",body)
-        notification.send_notification(subject,body,email)  # Calling the function from notification.py
+        notification.queue_notification(subject, body, email)  # Delivered by the background mail queue
 
         # Return success with user_id and JWT token
         return {"success": True, "user_id": user_data["user_id"], "token": create_access_token(user_data["user_id"])}
 
-    def login(self, email: str, password: str):
+    async def login(self, email: str, password: str):
         """
         Handle user login.
         Verifies the user's credentials and returns a JWT token on successful login.
         """
-        # Check if the user exists based on email
-        query = {
-            "query": {
-                "term": {
-                    "email": email
-                }
-            }
-        }
+        # Look up the user by email, with the password hash, bypassing the cache
+        user_data = await es_repository.get_document(self.index, normalize_email(email))
 
-        res = self.es.search(index=self.index, body=query)
-
-        if res['hits']['total']['value'] == 0:
+        if user_data is None:
             return {"success": False, "error": "User not found"}
 
-        user_data = res['hits']['hits'][0]['_source']
         result = {
             "user_id":user_data["user_id"],
             "email":user_data["email"],
             "username":user_data["username"]
         }
-        log.info(f"result {result}")
+        log.debug("Login attempt for user %s", result["user_id"])
 
         # Verify the password against the stored hash
-        if verify_password(user_data['password'], password):
+        if await password_hasher.verify(user_data['password'], password):
             token = create_access_token(user_data["user_id"])
             return {"success": True, "result": result, "token": token}
 
         return {"success": False, "error": "Invalid credentials"}
 
-    def update_user(self, user_id: str, username: str = None, password: str = None):
+    async def update_user(self, user_id: str, username: str = None, password: str = None):
         """
         Update the user's details (username or password).
         """
-        # Get user data by user_id
-        query = {
-            "query": {
-                "term": {
-                    "user_id": user_id
-                }
-            }
-        }
-
-        res = self.es.search(index=self.index, body=query)
+        # Resolve the user's email (the users document id) from user_id
+        email = await self.get_email_by_user_id(user_id)
 
-        if res['hits']['total']['value'] == 0:
+        if email is None:
             return {"success": False, "error": "User not found"}
 
-        user_data = res['hits']['hits'][0]['_source']
-
         # Prepare the update data
         update_data = {}
 
         if username:
             update_data["username"] = username
         if password:
-            update_data["password"] = hash_password(password)  # Hash the new password
+            update_data["password"] = await password_hasher.hash(password)  # Hash the new password
 
         # Update the document in Elasticsearch
         update_query = {
             "doc": update_data
         }
 
-        update_res = self.es.update(index=self.index, id=res['hits']['hits'][0]['_id'], body=update_query)
+        try:
+            await es_repository.update_document(self.index, email, update_query)
+        except es_repository.NotFoundError:
+            return {"success": False, "error": "User not found"}
+        await self.cache.delete(('email', email))
 
-        return {"success": True}
\ No newline at end of file
+        return {"success": True}
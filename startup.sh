@@ -1,2 +1,3 @@
-#!bin/bash
-uvicorn app:app --host 0.0.0.0 --port 8080 
\ No newline at end of file
+#!/bin/bash
+# Several uvicorn workers under gunicorn, see gunicorn.conf.py for the settings
+exec gunicorn -c gunicorn.conf.py app:app